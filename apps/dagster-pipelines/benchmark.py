@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+processed_data aggregation benchmark
+
+Compares the columnar group-by in aggregate_by_category against the per-record dict
+loop processed_data used before, at 10^6 and 10^7 records. Both run on the same
+generated records: the loop over them as a list of dicts, the way raw_data used to
+emit them. Results are checked to be equal and reported as records per second.
+
+    python benchmark.py
+    python benchmark.py --records 1000000 --repeat 5
+    python benchmark.py --records 10000000 --no-loop
+"""
+
+import argparse
+import sys
+import time
+from typing import Any
+
+from dagster_pipelines.definitions import aggregate_by_category, generate_records
+
+RECORDS = [1_000_000, 10_000_000]
+
+
+def loop_aggregate(records: list[dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    """The aggregation processed_data ran before the columnar change."""
+    aggregated = {}
+    for record in records:
+        category = record["category"]
+        if category not in aggregated:
+            aggregated[category] = {"count": 0, "total_value": 0}
+        aggregated[category]["count"] += 1
+        aggregated[category]["total_value"] += record["value"]
+
+    for category in aggregated:
+        aggregated[category]["avg_value"] = (
+            aggregated[category]["total_value"] / aggregated[category]["count"]
+        )
+    return aggregated
+
+
+def best_of(repeat: int, function, *args) -> tuple[float, Any]:
+    """Fastest of `repeat` calls, with the last result."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the processed_data aggregation")
+    parser.add_argument("--records", type=int, action="append",
+                        help="record count to run (repeatable, default: 10^6 and 10^7)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, best is kept")
+    parser.add_argument("--no-loop", action="store_true",
+                        help="skip the dict loop, which needs several GB of memory at 10^7 records")
+    args = parser.parse_args()
+
+    print(f"{'records':>11} {'method':<10} {'seconds':>8} {'records/s':>12} {'speedup':>8}")
+    for count in args.records or RECORDS:
+        generate_seconds, frame = best_of(1, generate_records, count, 0)
+        print(f"{count:>11} {'generate':<10} {generate_seconds:>8.3f} {count / generate_seconds:>12,.0f}")
+
+        columnar_seconds, columnar = best_of(args.repeat, aggregate_by_category, frame)
+        print(f"{count:>11} {'columnar':<10} {columnar_seconds:>8.3f} {count / columnar_seconds:>12,.0f}")
+
+        if args.no_loop:
+            continue
+        records = frame.astype({"category": str}).to_dict("records")
+        loop_seconds, looped = best_of(args.repeat, loop_aggregate, records)
+        del records
+        print(
+            f"{count:>11} {'loop':<10} {loop_seconds:>8.3f} {count / loop_seconds:>12,.0f} "
+            f"{loop_seconds / columnar_seconds:>7.1f}x"
+        )
+        if looped != columnar:
+            print(f"MISMATCH at {count} records: {looped} != {columnar}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,17 +2,69 @@
 Dagster Pipelines - Test data pipeline
 
 This module defines a demonstration data pipeline with:
-- Assets: Data processing steps following ETL pattern
+- Assets: Data processing steps following ETL pattern, partitioned by day
 - Jobs: Runnable pipeline definitions
 - Schedules: Automated daily execution
+- Sensors: Downstream rematerialization of updated partitions
 """
 
 import json
-import random
 from datetime import datetime
 from typing import Any
 
 import dagster as dg
+import numpy as np
+import pandas as pd
+
+
+CATEGORIES = ["A", "B", "C"]
+
+# One partition per day of data. Backfills launch one run per partition; the run queue
+# limits how many of a backfill's runs execute at once (see the dagster Helm values).
+daily_partitions = dg.DailyPartitionsDefinition(start_date="2026-01-01")
+
+# Materialize a partition once its upstream partition was updated, for any date rather
+# than only the latest one, so backfilled days propagate downstream
+partition_updated = dg.AutomationCondition.eager().without(
+    dg.AutomationCondition.in_latest_time_window()
+)
+
+
+# =============================================================================
+# Helpers: Columnar record generation and aggregation
+# =============================================================================
+
+
+def generate_records(record_count: int, seed: int | None = None) -> pd.DataFrame:
+    """Generate simulated records as a columnar frame: id, value (1-100) and category."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "id": np.arange(record_count),
+            "value": rng.integers(1, 101, size=record_count),
+            "category": pd.Categorical.from_codes(
+                rng.integers(0, len(CATEGORIES), size=record_count), categories=CATEGORIES
+            ),
+        }
+    )
+
+
+def aggregate_by_category(records: pd.DataFrame) -> dict[str, dict[str, Any]]:
+    """Count, sum and average value per category, in order of first appearance."""
+    if records.empty:
+        return {}
+    grouped = records.groupby("category", observed=True, sort=False)["value"].agg(
+        count="count", total_value="sum"
+    )
+    grouped["avg_value"] = grouped["total_value"] / grouped["count"]
+    return {
+        str(category): {
+            "count": int(stats["count"]),
+            "total_value": int(stats["total_value"]),
+            "avg_value": float(stats["avg_value"]),
+        }
+        for category, stats in grouped.to_dict("index").items()
+    }
 
 
 # =============================================================================
@@ -20,21 +72,26 @@ import dagster as dg
 # =============================================================================
 
 
+class RawDataConfig(dg.Config):
+    """Configuration for the simulated fetch."""
+
+    record_count: int = 10
+
+
 @dg.asset(
     description="Fetches raw data from external source (simulated)",
-    metadata={"source": "external_api", "format": "json"},
+    metadata={"source": "external_api", "format": "columnar"},
+    partitions_def=daily_partitions,
 )
-def raw_data(context: dg.AssetExecutionContext) -> dict[str, Any]:
-    """Simulate fetching data from an external API."""
-    context.log.info("Fetching raw data from external source...")
+def raw_data(context: dg.AssetExecutionContext, config: RawDataConfig) -> dict[str, Any]:
+    """Simulate fetching one day of data from an external API."""
+    context.log.info(f"Fetching raw data for {context.partition_key} from external source...")
     
-    # Simulated data representing daily metrics
+    # Simulated data representing daily metrics, the same on every rerun of the day
     data = {
         "timestamp": datetime.now().isoformat(),
-        "records": [
-            {"id": i, "value": random.randint(1, 100), "category": random.choice(["A", "B", "C"])}
-            for i in range(10)
-        ],
+        "partition": context.partition_key,
+        "records": generate_records(config.record_count, seed=int(context.partition_key.replace("-", ""))),
         "source": "demo_api",
     }
     
@@ -46,30 +103,21 @@ def raw_data(context: dg.AssetExecutionContext) -> dict[str, Any]:
     description="Transforms and enriches raw data",
     deps=[raw_data],
     metadata={"processing_type": "aggregation"},
+    partitions_def=daily_partitions,
+    automation_condition=partition_updated,
 )
 def processed_data(context: dg.AssetExecutionContext, raw_data: dict[str, Any]) -> dict[str, Any]:
     """Process and aggregate the raw data."""
     context.log.info("Processing raw data...")
     
-    records = raw_data.get("records", [])
+    records = raw_data["records"]
     
     # Aggregate by category
-    aggregated = {}
-    for record in records:
-        category = record["category"]
-        if category not in aggregated:
-            aggregated[category] = {"count": 0, "total_value": 0}
-        aggregated[category]["count"] += 1
-        aggregated[category]["total_value"] += record["value"]
-    
-    # Calculate averages
-    for category in aggregated:
-        aggregated[category]["avg_value"] = (
-            aggregated[category]["total_value"] / aggregated[category]["count"]
-        )
+    aggregated = aggregate_by_category(records)
     
     result = {
         "timestamp": raw_data.get("timestamp"),
+        "partition": raw_data.get("partition"),
         "processed_at": datetime.now().isoformat(),
         "aggregations": aggregated,
         "total_records": len(records),
@@ -83,6 +131,8 @@ def processed_data(context: dg.AssetExecutionContext, raw_data: dict[str, Any])
     description="Generates final data report",
     deps=[processed_data],
     metadata={"output_type": "report"},
+    partitions_def=daily_partitions,
+    automation_condition=partition_updated,
 )
 def data_report(context: dg.AssetExecutionContext, processed_data: dict[str, Any]) -> str:
     """Generate a human-readable report from processed data."""
@@ -93,6 +143,7 @@ def data_report(context: dg.AssetExecutionContext, processed_data: dict[str, Any
         "DATA PIPELINE REPORT",
         "=" * 50,
         f"Generated at: {datetime.now().isoformat()}",
+        f"Partition: {processed_data.get('partition')}",
         f"Source timestamp: {processed_data.get('timestamp')}",
         f"Total records processed: {processed_data.get('total_records')}",
         "",
@@ -169,13 +220,29 @@ test_failure_job = dg.define_asset_job(
     default_status=dg.DefaultScheduleStatus.STOPPED,
 )
 def daily_pipeline_schedule(context: dg.ScheduleEvaluationContext):
-    """Run the data pipeline daily at midnight."""
+    """Run the data pipeline daily at midnight, for the day that just ended."""
+    partition_key = daily_partitions.get_last_partition_key(
+        current_time=context.scheduled_execution_time
+    )
     return dg.RunRequest(
-        run_key=f"daily-{context.scheduled_execution_time.strftime('%Y-%m-%d')}",
+        run_key=f"daily-{partition_key}",
+        partition_key=partition_key,
         tags={"schedule": "daily", "automated": "true"},
     )
 
 
+# =============================================================================
+# Sensors: Automated downstream updates
+# =============================================================================
+
+data_pipeline_automation_sensor = dg.AutomationConditionSensorDefinition(
+    name="data_pipeline_automation_sensor",
+    target=dg.AssetSelection.assets(processed_data, data_report),
+    default_status=dg.DefaultSensorStatus.STOPPED,
+    description="Rematerialize processed_data and data_report partitions whose upstream partition changed",
+)
+
+
 # =============================================================================
 # Definitions: Register all components with resources
 # =============================================================================
@@ -184,5 +251,6 @@ defs = dg.Definitions(
     assets=[raw_data, processed_data, data_report, test_alert_failure],
     jobs=[data_pipeline_job, test_failure_job],
     schedules=[daily_pipeline_schedule],
+    sensors=[data_pipeline_automation_sensor],
 )
 
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+# Benchmark for render.py on synthetic organisation trees.
+#
+# Every scenario generates an org tree (.organisation, environments/, projects/) in a
+# temporary directory and renders one cluster of it in a fresh interpreter, timing the
+# load, filter, build and dump phases and recording peak RSS. The full `python3 render.py`
+# process is timed as well. Results can be saved as a baseline and later runs compared
+# against it, failing when any metric regresses by more than the threshold.
+#
+# --verify checks output instead: every cluster of gitops/org and of the edge-case tree in
+# golden/edge must render, with the libyaml and the pure-Python YAML layers, to what
+# render.py produced before the cache, index, server and libyaml changes (baseline commit
+# 53fd7c4), kept in golden/expected/<tree>/<environment>/<cluster>.yaml. The synthetic
+# scenarios must render identically with both layers.
+#
+# Runs offline with only PyYAML installed:
+#   python3 benchmark.py --save-baseline baseline.json
+#   python3 benchmark.py --baseline baseline.json --threshold 0.2
+#   python3 benchmark.py --verify
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import difflib
+import tempfile
+import subprocess
+import yaml
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_DIR = os.path.join(SCRIPTS_DIR, 'golden')
+# Trees with expected output under golden/expected/<tree>
+GOLDEN_TREES = {
+    'org': os.path.normpath(os.path.join(SCRIPTS_DIR, '..', '..', '..', '..', '..', '..', 'org')),
+    'edge': os.path.join(GOLDEN_DIR, 'edge'),
+}
+CLUSTERS = 3
+
+# name: (project files, applications)
+SCENARIOS = {
+    'small': (10, 100),
+    'medium': (100, 2000),
+    'large': (1000, 20000),
+}
+
+PHASES = ['load', 'filter', 'build', 'dump', 'total', 'process']
+
+# Phases faster than this are timer noise and never count as regressions
+NOISE_FLOOR_SECONDS = 0.005
+
+# Write a synthetic org tree with varied overrides, annotations and ignoreDifferences
+def generate_org(root, project_count, app_count, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(f'{root}/projects')
+    os.makedirs(f'{root}/environments')
+
+    defaults = {
+        'overlays_path': 'gitops/environments',
+        'annotations': {'qts.one/managed-by': 'organisation'},
+        'environment': {'DEBUG': 'false'},
+        'overrides': {},
+        'ignoreDifferences': [],
+        'syncPolicy': {
+            'automated': {'selfHeal': True, 'prune': False},
+            'syncOptions': ['CreateNamespace=true', 'ApplyOutOfSyncOnly=true', 'RespectIgnoreDifferences=true'],
+        },
+    }
+    with open(f'{root}/.organisation', 'w') as file:
+        yaml.safe_dump(defaults, file)
+
+    apps = [f'app-{i:05d}' for i in range(app_count)]
+    for p in range(project_count):
+        project = {
+            'kind': 'Project',
+            'apiVersion': 'qts.one/v1beta1',
+            'metadata': {'name': f'project-{p:04d}'},
+            'spec': {
+                'appProject': {
+                    'description': f'Project {p}',
+                    'sourceRepos': ['*'],
+                    'destinations': [{'namespace': '*', 'server': 'https://kubernetes.default.svc'}],
+                },
+                'applications': [],
+            },
+        }
+        if rng.random() < 0.3:
+            project['metadata']['annotations'] = {'argocd.argoproj.io/sync-wave': str(rng.randint(-100, -10))}
+
+        for name in apps[p::project_count]:
+            app = {
+                'name': name,
+                'repoURL': 'https://git.example.com/org/infra.git',
+                'targetRevision': 'main',
+                'overlays_path': f'gitops/services/{name}/environments',
+            }
+            if rng.random() < 0.3:
+                app['namespace'] = f'ns-{name}'
+            if rng.random() < 0.2:
+                app['annotations'] = {'argocd.argoproj.io/sync-wave': str(rng.randint(0, 10))}
+            if rng.random() < 0.2:
+                app['ignoreDifferences'] = [{
+                    'group': 'apps',
+                    'kind': 'StatefulSet',
+                    'jqPathExpressions': ['.spec.volumeClaimTemplates[]?.apiVersion'],
+                }]
+            if rng.random() < 0.2:
+                app['syncPolicy'] = {
+                    'automated': {'selfHeal': rng.choice([True, False]), 'prune': rng.choice([True, False])},
+                    'syncOptions': ['CreateNamespace=true', 'ServerSideApply=true'],
+                }
+            project['spec']['applications'].append(app)
+
+        with open(f'{root}/projects/project-{p:04d}.yaml', 'w') as file:
+            yaml.safe_dump(project, file)
+
+    clusters = []
+    for c in range(CLUSTERS):
+        cluster_apps = []
+        for name in rng.sample(apps, max(1, app_count * 2 // 3)):
+            cluster_app = {'name': name}
+            if rng.random() < 0.2:
+                cluster_app['environment'] = {'REPLICAS': str(rng.randint(1, 5))}
+            if rng.random() < 0.1:
+                cluster_app['overrides'] = {'overlay_dir': 'custom'}
+            if rng.random() < 0.1:
+                cluster_app['annotations'] = {'qts.one/cluster': f'cluster-{c}'}
+            if rng.random() < 0.05:
+                cluster_app['ignoreDifferences'] = [{'group': '', 'kind': 'Service', 'jsonPointers': ['/spec/clusterIP']}]
+            cluster_apps.append(cluster_app)
+        clusters.append({'name': f'cluster-{c}', 'applications': cluster_apps})
+
+    environment = {
+        'kind': 'Environment',
+        'apiVersion': 'qts.one/v1beta1',
+        'metadata': {'name': 'benchmark'},
+        'spec': {'clusters': clusters},
+    }
+    with open(f'{root}/environments/benchmark.yaml', 'w') as file:
+        yaml.safe_dump(environment, file)
+
+# Render cluster-0 of the tree in the current directory, phase by phase (runs in a child process)
+def measure_phases():
+    import io
+    sys.path.insert(0, SCRIPTS_DIR)
+    import render
+
+    started = time.perf_counter()
+    defaults = render.load_yaml('.organisation')
+    environment_data = render.load_yaml('environments/benchmark.yaml')
+    index = render.load_index(render.index_file('benchmark'))
+    parsed = render.update_index(index, render.index_file('benchmark'))
+    loaded = time.perf_counter()
+
+    cluster_apps, project_files = render.select('cluster-0', environment_data, index)
+    filtered = time.perf_counter()
+
+    documents = list(render.build(cluster_apps, project_files, 'benchmark', render.Resolver(defaults), parsed))
+    built = time.perf_counter()
+
+    output = io.BytesIO()
+    render.emit(documents, output)
+    dumped = time.perf_counter()
+
+    return {
+        'load': loaded - started,
+        'filter': filtered - loaded,
+        'build': built - filtered,
+        'dump': dumped - built,
+        'total': dumped - started,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'documents': len(documents),
+        'bytes': output.tell(),
+    }
+
+def child_env(cache_dir):
+    env = dict(os.environ)
+    env.update({
+        'ORG_RENDER_CACHE': 'false',
+        'ORG_RENDER_CACHE_DIR': cache_dir,
+        'ARGOCD_APP_NAME': 'benchmark',
+        'CLUSTER_NAME': 'cluster-0',
+        'ARGOCD_ENV_ENVIRONMENT': 'benchmark',
+    })
+    return env
+
+# Best of `repeat` runs, each in a fresh interpreter with a cold index
+def run_scenario(root, repeat):
+    best = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            env = child_env(cache_dir)
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--measure'],
+                cwd=root, env=env, check=True, capture_output=True, text=True,
+            )
+            metrics = json.loads(result.stdout)
+
+            started = time.perf_counter()
+            subprocess.run(
+                [sys.executable, os.path.join(SCRIPTS_DIR, 'render.py')],
+                cwd=root, env=env, check=True, stdout=subprocess.DEVNULL,
+            )
+            metrics['process'] = time.perf_counter() - started
+
+        if best is None:
+            best = metrics
+        else:
+            for phase in PHASES:
+                best[phase] = min(best[phase], metrics[phase])
+            best['peak_rss_mib'] = min(best['peak_rss_mib'], metrics['peak_rss_mib'])
+    return best
+
+# Output of `python3 render.py` for one cluster of the tree, with a cold cache and index
+def render_output(root, environment, cluster, libyaml):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = child_env(cache_dir)
+        env.update({'ARGOCD_ENV_ENVIRONMENT': environment, 'CLUSTER_NAME': cluster, 'ORG_RENDER_LIBYAML': libyaml})
+        result = subprocess.run(
+            [sys.executable, os.path.join(SCRIPTS_DIR, 'render.py')],
+            cwd=root, env=env, check=True, capture_output=True,
+        )
+    return result.stdout
+
+# Documents of a render, in a fixed order. Projects come in os.listdir order, in the
+# baseline renderer too, so documents are compared byte for byte but not by position.
+def documents(output):
+    return sorted(re.split(rb'^---\n', output, flags=re.M))
+
+# Render every cluster with expected output with both YAML layers and diff it against the
+# expected output; True when all match
+def verify_golden():
+    matched = True
+    for tree, root in GOLDEN_TREES.items():
+        expected_dir = os.path.join(GOLDEN_DIR, 'expected', tree)
+        for environment in sorted(os.listdir(expected_dir)):
+            for expected_file in sorted(os.listdir(os.path.join(expected_dir, environment))):
+                cluster = expected_file[:-len('.yaml')]
+                with open(os.path.join(expected_dir, environment, expected_file), 'rb') as file:
+                    expected = file.read()
+                for libyaml in ['true', 'false']:
+                    output = render_output(root, environment, cluster, libyaml)
+                    name = f"{tree}/{environment}/{cluster} ({'libyaml' if libyaml == 'true' else 'pure-Python'})"
+                    if documents(output) == documents(expected):
+                        print(f"{name}: matches golden/expected")
+                        continue
+                    matched = False
+                    print(f"{name}: DIFFERS from golden/expected")
+                    sys.stdout.writelines(difflib.unified_diff(
+                        expected.decode().splitlines(keepends=True), output.decode().splitlines(keepends=True),
+                        f'golden/expected/{tree}/{environment}/{expected_file}', 'render.py',
+                    ))
+    return matched
+
+# Render the tree with the libyaml and the pure-Python YAML layers; both must match byte for byte
+def verify_scenario(root):
+    outputs = [render_output(root, 'benchmark', 'cluster-0', libyaml) for libyaml in ['true', 'false']]
+    return outputs[0] == outputs[1]
+
+# Metrics that grew by more than threshold over the baseline
+def regressions(results, baseline, threshold):
+    found = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        for metric in PHASES + ['peak_rss_mib']:
+            previous = baseline[name].get(metric)
+            if metric in PHASES and max(previous or 0, metrics[metric]) < NOISE_FLOOR_SECONDS:
+                continue
+            if previous and metrics[metric] > previous * (1 + threshold):
+                found.append(f"{name}.{metric}: {previous:.3f} -> {metrics[metric]:.3f} (+{metrics[metric] / previous - 1:.0%})")
+    return found
+
+def report(results):
+    print(f"{'scenario':<10} {'projects':>8} {'apps':>6} {'docs':>6} "
+          + ' '.join(f'{phase + " s":>9}' for phase in PHASES) + f" {'peak MiB':>9}")
+    for name, metrics in results.items():
+        print(f"{name:<10} {metrics['projects']:>8} {metrics['applications']:>6} {metrics['documents']:>6} "
+              + ' '.join(f'{metrics[phase]:>9.3f}' for phase in PHASES) + f" {metrics['peak_rss_mib']:>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark render.py on synthetic organisation trees')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help="scenario to run (repeatable, default: all)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario, best is kept")
+    parser.add_argument('--baseline', help="compare against this baseline file")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="allowed relative regression over the baseline (default: 0.2)")
+    parser.add_argument('--save-baseline', help="write the results to this baseline file")
+    parser.add_argument('--verify', action='store_true',
+                        help="only check output against golden/expected, and libyaml against pure-Python output")
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        json.dump(measure_phases(), sys.stdout)
+        return 0
+
+    if args.verify and not verify_golden():
+        return 1
+
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        project_count, app_count = SCENARIOS[name]
+        with tempfile.TemporaryDirectory() as root:
+            generate_org(root, project_count, app_count)
+            if args.verify:
+                identical = verify_scenario(root)
+                print(f"{name}: libyaml and pure-Python output {'identical' if identical else 'DIFFER'}")
+                if not identical:
+                    return 1
+                continue
+            results[name] = run_scenario(root, args.repeat)
+        results[name].update(projects=project_count, applications=app_count)
+    if args.verify:
+        return 0
+    report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        found = regressions(results, baseline, args.threshold)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
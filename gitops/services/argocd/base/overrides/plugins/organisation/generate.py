@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Thin generate client for the organisation plugin.
+# Asks the resident render server (render.py --serve) for the output and falls back to
+# rendering in-process when it is not reachable, starting it for the next generate.
+# Keep imports minimal: avoiding interpreter work here is the whole point.
+#
+# The server reads its ORG_RENDER_* settings once, when it starts. Requests carry the
+# client's settings; a server started with other ones declines and exits, so the render
+# happens in-process and the next generate starts a server with the new settings.
+# Applications with DEBUG enabled always render in-process, so their debug log ends up
+# in their own log file.
+
+import os
+import sys
+import json
+import socket
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_ENABLED = os.environ.get('ORG_RENDER_SERVER', 'true').lower() != 'false'
+SERVER_SOCKET = os.environ.get('ORG_RENDER_SOCKET', '/tmp/org-render.sock')
+# Seconds to connect and have the request picked up; the render itself is not limited
+SERVER_TIMEOUT = float(os.environ.get('ORG_RENDER_SERVER_TIMEOUT', '2'))
+
+# Fetch the render from the server; returns None if it is down or the render failed
+def request():
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(SERVER_TIMEOUT)
+        sock.connect(SERVER_SOCKET)
+        sock.sendall(json.dumps({
+            'cluster': os.getenv('CLUSTER_NAME'),
+            'environment': os.getenv('ARGOCD_ENV_ENVIRONMENT'),
+            'path': os.getcwd(),
+            'app': os.getenv('ARGOCD_APP_NAME'),
+            'settings': {key: value for key, value in os.environ.items() if key.startswith('ORG_RENDER_')},
+        }).encode() + b'\n')
+
+        response = sock.makefile('rb')
+        if json.loads(response.readline()).get('status') != 'accepted':
+            return None
+        sock.settimeout(None)
+        status = json.loads(response.readline())
+        if status.get('status') != 'ok':
+            return None
+        output = response.read(status['length'])
+        # A short read means the server went away mid-response
+        if len(output) != status['length']:
+            return None
+        return output
+
+def start_server():
+    import subprocess
+    subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPTS_DIR, 'render.py'), '--serve'],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd='/',
+        start_new_session=True,
+    )
+
+def main():
+    if SERVER_ENABLED and os.environ.get('ARGOCD_ENV_DEBUG') != 'true':
+        try:
+            output = request()
+        except (OSError, ValueError):
+            output = None
+            start_server()
+        if output is not None:
+            sys.stdout.buffer.write(output)
+            return
+
+    # Server down or failed: render in-process so errors surface in this generate
+    sys.path.insert(0, SCRIPTS_DIR)
+    import render
+    render.main()
+
+if __name__ == '__main__':
+    main()
@@ -1,169 +1,740 @@
 #!/usr/bin/env python
 
 import os
+import io
+import json
 import sys
-import yaml
-from functools import reduce
-import operator
+import time
+import fcntl
+import shutil
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import socketserver
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import logging
+import yaml
 
 LOGFILE=f'/tmp/{os.environ.get("ARGOCD_APP_NAME")}.org.render.log'
-logging.basicConfig(filename=LOGFILE, level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+LOGFORMAT='%(asctime)s - %(levelname)s - %(message)s'
+# Per-item logging is only produced with DEBUG enabled, like the qts plugin
+LOGLEVEL=logging.DEBUG if os.environ.get('ARGOCD_ENV_DEBUG') == 'true' else logging.INFO
+
+# Render metrics: one JSON record per render, plus an optional Prometheus textfile-collector file
+METRICS_MAX_BYTES = int(os.environ.get('ORG_RENDER_METRICS_MAX_BYTES', str(1024 * 1024)))
+METRICS_TEXTFILE_DIR = os.environ.get('ORG_RENDER_TEXTFILE_DIR')
+
+# Render cache (lives on the repo-server /tmp volume, shared by all generate calls)
+CACHE_ENABLED = os.environ.get('ORG_RENDER_CACHE', 'true').lower() != 'false'
+CACHE_DIR = os.environ.get('ORG_RENDER_CACHE_DIR', '/tmp/org-render-cache')
+CACHE_MAX_ENTRIES = int(os.environ.get('ORG_RENDER_CACHE_MAX_ENTRIES', '256'))
+CACHE_MAX_BYTES = int(os.environ.get('ORG_RENDER_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Application -> project index, one per ArgoCD application using the plugin
+INDEX_VERSION = 1
+
+# Resident render server (see generate.py for the client side)
+SERVER_SOCKET = os.environ.get('ORG_RENDER_SOCKET', '/tmp/org-render.sock')
+SERVER_LOGFILE = '/tmp/org.render-server.log'
+SERVER_MAX_DOCUMENTS = int(os.environ.get('ORG_RENDER_SERVER_MAX_DOCUMENTS', '4096'))
+
+# Parsed documents by content digest, only kept in memory by the render server
+DOCUMENTS = None
+
+# libyaml C loader/dumper when available, pure-Python fallback otherwise (same output)
+if os.environ.get('ORG_RENDER_LIBYAML', 'true').lower() != 'false' and yaml.__with_libyaml__:
+    SafeLoader, Dumper = yaml.CSafeLoader, yaml.CDumper
+else:
+    SafeLoader, Dumper = yaml.SafeLoader, yaml.Dumper
+
+# Inputs shared by batch render workers, inherited on fork
+BATCH = None
+
+# Marks a path that does not exist, as opposed to one set to null
+MISSING = object()
+
+# Compile a dotted path into an accessor returning MISSING instead of raising
+def compile_path(element):
+    keys = element.split('.')
+    def get(data):
+        for key in keys:
+            if not isinstance(data, dict):
+                return MISSING
+            data = data.get(key, MISSING)
+            if data is MISSING:
+                return MISSING
+        return data
+    return get
+
+# Application fields that fall back to .organisation when an application does not set them
+OVERLAYS_PATH = compile_path('overlays_path')
+SYNC_OPTIONS = compile_path('syncPolicy.syncOptions')
+SELF_HEAL = compile_path('syncPolicy.automated.selfHeal')
+PRUNE = compile_path('syncPolicy.automated.prune')
+
+# Layered resolution of AppProject and Application fields: defaults -> project -> app -> cluster app.
+# The defaults layer is resolved once, project and app layers are memoized per project file so a
+# resolver shared across clusters (batch mode) resolves each of them only once.
+class Resolver:
+    def __init__(self, defaults):
+        self.annotations = defaults.get('annotations') or {}
+        self.environment = defaults.get('environment') or {}
+        self.overrides = defaults.get('overrides') or {}
+        self.ignore_differences = defaults.get('ignoreDifferences')
+        self.fields = {
+            'overlays_path': OVERLAYS_PATH(defaults),
+            'syncOptions': SYNC_OPTIONS(defaults),
+            'selfHeal': SELF_HEAL(defaults),
+            'prune': PRUNE(defaults),
+        }
+        self.projects = {}
+        self.apps = {}
 
-# Find default value
-def find(element, dict, default):
+    # Field set by the app or else by .organisation; missing from both is an error, as before
+    def field(self, name, accessor, app):
+        value = accessor(app)
+        if value is MISSING:
+            value = self.fields[name]
+            if value is MISSING:
+                raise KeyError(name)
+        return value
+
+    def project(self, project_file, project_data):
+        layer = self.projects.get(project_file)
+        if layer is None:
+            annotations = {**self.annotations, **(project_data.get('metadata', {}).get('annotations', {}) or {})}
+            # Always ensure the sync-wave is set to at least -10 (projects must be created before apps)
+            annotations.setdefault('argocd.argoproj.io/sync-wave', "-10")
+            layer = self.projects[project_file] = {
+                'name': project_data['metadata']['name'],
+                'annotations': annotations,
+            }
+        return layer
+
+    def app(self, project_file, app):
+        key = (project_file, app['name'])
+        layer = self.apps.get(key)
+        if layer is None:
+            ignore_differences = app.get('ignoreDifferences')
+            if ignore_differences is None:
+                ignore_differences = self.ignore_differences
+            layer = self.apps[key] = {
+                'annotations': {**self.annotations, **(app.get('annotations', {}) or {})},
+                'overlays_path': self.field('overlays_path', OVERLAYS_PATH, app),
+                'syncOptions': self.field('syncOptions', SYNC_OPTIONS, app),
+                'selfHeal': self.field('selfHeal', SELF_HEAL, app),
+                'prune': self.field('prune', PRUNE, app),
+                'ignoreDifferences': ignore_differences,
+            }
+        return layer
+
+# Parse YAML content, memoized by digest when running as the render server. Concurrent
+# requests may parse the same content twice, which is harmless.
+def parse_yaml(content, digest=None):
+    if DOCUMENTS is None:
+        return yaml.load(content, Loader=SafeLoader)
+    digest = digest or hashlib.sha256(content).hexdigest()
+    document = DOCUMENTS.get(digest)
+    if document is None:
+        if len(DOCUMENTS) >= SERVER_MAX_DOCUMENTS:
+            DOCUMENTS.clear()
+        document = DOCUMENTS[digest] = yaml.load(content, Loader=SafeLoader)
+    return document
+
+def load_yaml(path):
+    with open(path, 'rb') as file:
+        return parse_yaml(file.read())
+
+def index_file(app_name):
+    return os.path.join(CACHE_DIR, f'index-{app_name or "default"}.json')
+
+# Load the application index, starting from scratch if missing, corrupt or outdated
+def load_index(path):
+    try:
+        with open(path, 'r') as file:
+            index = json.load(file)
+        if index.get('version') == INDEX_VERSION:
+            return index
+        logging.debug("Discarding index '%s' with version '%s'", path, index.get('version'))
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        logging.warning("Discarding corrupt index '%s'", path)
+    return {'version': INDEX_VERSION, 'projects': {}, 'applications': {}}
+
+def save_index(index, path):
     try:
-        value = reduce(operator.getitem, element.split('.'), dict)
-    except:
-        value = reduce(operator.getitem, element.split('.'), default)
-    return value
-
-# Load .organisation
-logging.debug("Loading .organisation")
-with open('.organisation', 'r') as file:
-    defaults = yaml.safe_load(file)
-
-# Current cluster name and environment from environment variables
-cluster_name = os.getenv('CLUSTER_NAME')
-environment = os.getenv('ARGOCD_ENV_ENVIRONMENT')
-
-logging.debug(f"ClusterName: '{cluster_name}'")
-logging.debug(f"Environment: '{environment}'")
-
-# Load environment configuration
-with open(f'environments/{environment}.yaml', 'r') as file:
-    environment_data = yaml.safe_load(file)
-
-# Filter clusters by name
-clusters = [c for c in environment_data['spec']['clusters'] if c['name'] == cluster_name]
-
-# If no matching clusters found, exit
-if not clusters:
-    logging.error(f"No matching clusters found for '{cluster_name}'")
-    exit()
-
-# Applications for the matching cluster
-cluster_apps = {app['name']: app for app in clusters[0]['applications']}
-
-projects = []
-applications = []
-
-# Process all projects
-for project_file in os.listdir('projects'):
-    with open(f'projects/{project_file}', 'r') as file:
-        project_data = yaml.safe_load(file)
-
-    logging.debug(f"Project: '{project_data['metadata']['name']}'")
-
-    # Filter project applications by those present in the cluster
-    project_apps = [app for app in project_data['spec']['applications'] if app['name'] in cluster_apps]
-
-    # If no matching applications found, continue to next project
-    if not project_apps:
-        logging.debug(f"No matching applications found for project '{project_data['metadata']['name']}'")
-        continue
-
-    # Get project annotations (from defaults and project data)
-    project_annotations = defaults.get('annotations', {}).copy()
-    project_annotations.update(project_data.get('metadata', {}).get('annotations', {}) or {})
-    
-    # Always ensure the sync-wave is set to at least -10 (projects must be created before apps)
-    project_annotations['argocd.argoproj.io/sync-wave'] = project_annotations.get('argocd.argoproj.io/sync-wave', "-10")
-
-    # Create AppProject
-    app_project = {
-        'apiVersion': 'argoproj.io/v1alpha1',
-        'kind': 'AppProject',
-        'metadata': {
-            'name': project_data['metadata']['name'],
-            'namespace': 'argocd',
-            'annotations': project_annotations
-        },
-        'spec': project_data['spec']['appProject']
-    }
-
-    projects.append(app_project)
-
-    # Create Application for each matching application in the project
-    for app in project_apps:
-        logging.debug(f"Application: '{app['name']}'")
-
-        cluster_app = cluster_apps[app['name']]
-        logging.debug(f"Cluster Application: '{cluster_app['name']}'")
-        # Get Application ENV VARS (defaults and defined in environment.yaml)
-        app_env_vars = defaults.get('environment', {}).copy()
-        app_env_vars.update(cluster_app.get('environment', {}) or {})
-        
-        # Get Application Overrides (defaults and defined in environment.yaml)
-        app_overrides = defaults.get('overrides', {}).copy()
-        app_overrides.update(cluster_app.get('overrides', {}) or {})
-        
-        # Set values
-        app_overlay_dir = app_overrides.get('overlay_dir', environment)
-        app_overlay_path = app_overrides.get('overlays_path', find('overlays_path', app, defaults))
-        app_overlay_path = f"{app_overlay_path}/{app_overlay_dir}"
-
-        # Get application annotations (from defaults, app definition, and cluster_app)
-        app_annotations = defaults.get('annotations', {}).copy()
-        app_annotations.update(app.get('annotations', {}) or {})
-        app_annotations.update(cluster_app.get('annotations', {}) or {})
-
-        application = {
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(index, file)
+        os.replace(tmp_path, path)
+    except OSError:
+        logging.exception("Failed to write index '%s'", path)
+
+# Bring the index in line with <root>/projects and return the project data parsed on the
+# way. Files with unchanged mtime and size are trusted as-is, changed ones are re-hashed
+# and only re-parsed when their digest differs.
+def update_index(index, path, root='.'):
+    parsed = {}
+    projects = {}
+    changed = False
+
+    projects_dir = os.path.join(root, 'projects')
+    for project_file in os.listdir(projects_dir):
+        stat = os.stat(os.path.join(projects_dir, project_file))
+        entry = index['projects'].get(project_file)
+        if entry and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            projects[project_file] = entry
+            continue
+
+        with open(os.path.join(projects_dir, project_file), 'rb') as file:
+            content = file.read()
+        digest = hashlib.sha256(content).hexdigest()
+
+        if entry and entry['digest'] == digest:
+            entry = dict(entry)
+        else:
+            logging.debug("Indexing project file '%s'", project_file)
+            project_data = parse_yaml(content, digest)
+            parsed[project_file] = project_data
+            entry = {
+                'digest': digest,
+                'applications': [app['name'] for app in project_data['spec']['applications']],
+            }
+        entry['mtime_ns'] = stat.st_mtime_ns
+        entry['size'] = stat.st_size
+        projects[project_file] = entry
+        changed = True
+
+    if changed or projects.keys() != index['projects'].keys():
+        applications = {}
+        for project_file, entry in projects.items():
+            for app_name in entry['applications']:
+                applications.setdefault(app_name, []).append(project_file)
+        index['projects'] = projects
+        index['applications'] = applications
+        save_index(index, path)
+
+    return parsed
+
+# Digest of the renderer, the inputs, the cluster and the environment
+def cache_key(cluster_name, environment, index, root='.'):
+    digest = hashlib.sha256()
+    # Include the renderer itself so a plugin upgrade never serves stale output
+    for path in [__file__, os.path.join(root, '.organisation'), os.path.join(root, 'environments', f'{environment}.yaml')]:
+        with open(path, 'rb') as file:
+            digest.update(hashlib.sha256(file.read()).digest())
+    digest.update(f'{cluster_name}\0{environment}\0'.encode())
+    # Project files are covered by the digests the index already holds
+    for project_file in sorted(index['projects']):
+        digest.update(f"{project_file}\0{index['projects'][project_file]['digest']}\0".encode())
+    return digest.hexdigest()
+
+# Stream a cached render to out; returns False on a miss
+def cache_get(key, out):
+    path = os.path.join(CACHE_DIR, f'{key}.yaml')
+    try:
+        with open(path, 'rb') as file:
+            # Bump mtime, which is what LRU eviction orders by
+            os.utime(path)
+            shutil.copyfileobj(file, out)
+    except FileNotFoundError:
+        return False
+    return True
+
+# Binary stream writing to several streams at once
+class Tee:
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+
+# Stream a render to out while spooling it to the cache; the entry is atomically stored
+# and the least recently used entries evicted only once the render completed
+@contextlib.contextmanager
+def cache_put(key, out):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix='.tmp-')
+    except OSError:
+        logging.exception("Failed to create render cache entry")
+        yield out
+        return
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            yield Tee(out, file)
+        os.replace(tmp_path, os.path.join(CACHE_DIR, f'{key}.yaml'))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    cache_evict()
+
+def cache_evict():
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if not entry.name.endswith('.yaml'):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    # Newest first, drop everything past the entry or byte budget
+    entries.sort(reverse=True)
+    total_bytes = 0
+    for count, (_, size, path) in enumerate(entries, start=1):
+        total_bytes += size
+        if count > CACHE_MAX_ENTRIES or total_bytes > CACHE_MAX_BYTES:
+            logging.debug("Evicting render cache entry '%s'", path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+# Applications of a cluster and the project files the index lists as containing one of them
+def select(cluster_name, environment_data, index):
+    # Filter clusters by name
+    clusters = [c for c in environment_data['spec']['clusters'] if c['name'] == cluster_name]
+
+    # If no matching clusters found, select nothing
+    if not clusters:
+        logging.error("No matching clusters found for '%s'", cluster_name)
+        return {}, []
+
+    # Applications for the matching cluster
+    cluster_apps = {app['name']: app for app in clusters[0]['applications']}
+
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    project_files = []
+    for project_file, entry in index['projects'].items():
+        if not any(app_name in cluster_apps for app_name in entry['applications']):
+            if debug:
+                logging.debug("No matching applications found in project file '%s'", project_file)
+            continue
+        project_files.append(project_file)
+
+    return cluster_apps, project_files
+
+# Yield AppProjects, then Applications, of the selected cluster applications and project files
+# as they are built. Project files not parsed yet are loaded here, from <root>/projects.
+def build(cluster_apps, project_files, environment, resolver, parsed, root='.'):
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    projects = []
+
+    # AppProjects first, for projects containing at least one cluster application
+    for project_file in project_files:
+        project_data = parsed.get(project_file)
+        if project_data is None:
+            project_data = load_yaml(os.path.join(root, 'projects', project_file))
+
+        project = resolver.project(project_file, project_data)
+        if debug:
+            logging.debug("Project: '%s'", project['name'])
+
+        # Create AppProject
+        yield {
             'apiVersion': 'argoproj.io/v1alpha1',
-            'kind': 'Application',
+            'kind': 'AppProject',
             'metadata': {
-                'name': app.get('name'),
-                'annotations': app_annotations,
-                'finalizers': ['resources-finalizer.argocd.argoproj.io']
+                'name': project['name'],
+                'namespace': 'argocd',
+                'annotations': project['annotations']
             },
-            'spec': {
-                'project': project_data['metadata']['name'],
-                'source': {
-                    'repoURL': app.get('repoURL'),
-                    'path': app_overlay_path,
-                    'targetRevision': app.get('targetRevision'),
-                },
-                'destination': {
-                    'server': 'https://kubernetes.default.svc',
-                    'namespace': app.get('namespace', str(app.get('name'))),
-                },
-                "syncPolicy": {
-                    "syncOptions": find("syncPolicy.syncOptions", app, defaults)
+            'spec': project_data['spec']['appProject']
+        }
+        projects.append((project_file, project, project_data))
+
+    # Then an Application for each application of those projects present in the cluster
+    for project_file, project, project_data in projects:
+        for app in project_data['spec']['applications']:
+            cluster_app = cluster_apps.get(app['name'])
+            if cluster_app is None:
+                continue
+            if debug:
+                logging.debug("Application: '%s'", app['name'])
+
+            layer = resolver.app(project_file, app)
+
+            # Get Application ENV VARS (defaults and defined in environment.yaml)
+            app_env_vars = {**resolver.environment, **(cluster_app.get('environment', {}) or {})}
+
+            # Get Application Overrides (defaults and defined in environment.yaml)
+            app_overrides = {**resolver.overrides, **(cluster_app.get('overrides', {}) or {})}
+
+            # Set values
+            app_overlay_dir = app_overrides.get('overlay_dir', environment)
+            app_overlay_path = app_overrides.get('overlays_path', layer['overlays_path'])
+            app_overlay_path = f"{app_overlay_path}/{app_overlay_dir}"
+
+            # Get application annotations (from defaults, app definition, and cluster_app)
+            app_annotations = {**layer['annotations'], **(cluster_app.get('annotations', {}) or {})}
+
+            application = {
+                'apiVersion': 'argoproj.io/v1alpha1',
+                'kind': 'Application',
+                'metadata': {
+                    'name': app.get('name'),
+                    'annotations': app_annotations,
+                    'finalizers': ['resources-finalizer.argocd.argoproj.io']
                 },
+                'spec': {
+                    'project': project['name'],
+                    'source': {
+                        'repoURL': app.get('repoURL'),
+                        'path': app_overlay_path,
+                        'targetRevision': app.get('targetRevision'),
+                    },
+                    'destination': {
+                        'server': 'https://kubernetes.default.svc',
+                        'namespace': app.get('namespace', str(app.get('name'))),
+                    },
+                    "syncPolicy": {
+                        "syncOptions": layer['syncOptions']
+                    },
+                }
             }
+
+            # Add plugin section only if env variables exist
+            if app_env_vars:
+                application['spec']['source']['plugin'] = {
+                    'env': [{'name': str(key), 'value': str(value)} for key, value in app_env_vars.items()]
+                }
+
+            # Add ignoreDifferences support (cluster app, then app, then defaults)
+            ignore_differences = cluster_app.get('ignoreDifferences')
+            if ignore_differences is None:
+                ignore_differences = layer['ignoreDifferences']
+            if ignore_differences:
+                application['spec']['ignoreDifferences'] = ignore_differences
+
+            # Add automated sync policy only if selfHeal or prune are not false
+            self_heal = layer['selfHeal']
+            prune = layer['prune']
+
+            if self_heal is not False or prune is not False:
+                application['spec']['syncPolicy']['automated'] = {}
+                if self_heal is not False:
+                    application['spec']['syncPolicy']['automated']['selfHeal'] = self_heal
+                if prune is not False:
+                    application['spec']['syncPolicy']['automated']['prune'] = prune
+
+            yield application
+
+# Write documents to the binary stream out as they come, each preceded by '---'
+def emit(documents, out):
+    dumper = Dumper(out, explicit_start=True, encoding='utf-8')
+    try:
+        dumper.open()
+        for document in documents:
+            dumper.represent(document)
+        dumper.close()
+    finally:
+        dumper.dispose()
+
+# Escape a Prometheus label value
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Wall time per phase and counters of a single render
+class RenderMetrics:
+    def __init__(self, app_name, cluster_name, environment):
+        self.app_name = app_name
+        self.started = time.perf_counter()
+        self.record = {
+            'timestamp': time.time(),
+            'app': app_name,
+            'cluster': cluster_name,
+            'environment': environment,
+            'cache': None,
+            'phases': {},
+            'projects': {'scanned': 0, 'emitted': 0},
+            'applications': {'scanned': 0, 'emitted': 0},
         }
 
-        # Add plugin section only if env variables exist
-        if app_env_vars:
-            application['spec']['source']['plugin'] = {
-                'env': [{'name': str(key), 'value': str(value)} for key, value in app_env_vars.items()]
-            }
+    def add(self, phase, seconds):
+        phases = self.record['phases']
+        phases[phase] = phases.get(phase, 0) + seconds
 
-        # Add ignoreDifferences support:
-        ignore_differences = cluster_app.get('ignoreDifferences')
-        if ignore_differences is None:
-            ignore_differences = app.get('ignoreDifferences')
-        if ignore_differences is None:
-            ignore_differences = defaults.get('ignoreDifferences')
-        if ignore_differences:
-            application['spec']['ignoreDifferences'] = ignore_differences
-
-        # Add automated sync policy only if selfHeal or prune are not false
-        self_heal = find("syncPolicy.automated.selfHeal", app, defaults)
-        prune = find("syncPolicy.automated.prune", app, defaults)
-        
-        if self_heal is not False or prune is not False:
-            application['spec']['syncPolicy']['automated'] = {}
-            if self_heal is not False:
-                application['spec']['syncPolicy']['automated']['selfHeal'] = self_heal
-            if prune is not False:
-                application['spec']['syncPolicy']['automated']['prune'] = prune
-
-        applications.append(application)
-
-for project in projects:
-    print("---")
-    yaml.dump(project, sys.stdout)
-for app in applications:
-    print("---")
-    yaml.dump(app, sys.stdout)
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def scanned(self, index):
+        self.record['projects']['scanned'] = len(index['projects'])
+        self.record['applications']['scanned'] = sum(len(entry['applications']) for entry in index['projects'].values())
+
+    # Time spent producing documents goes to the build phase, and count them by kind
+    def built(self, documents):
+        documents = iter(documents)
+        counters = {'AppProject': self.record['projects'], 'Application': self.record['applications']}
+        while True:
+            started = time.perf_counter()
+            try:
+                document = next(documents)
+            except StopIteration:
+                self.add('build', time.perf_counter() - started)
+                return
+            self.add('build', time.perf_counter() - started)
+            counters[document['kind']]['emitted'] += 1
+            yield document
+
+    def write(self):
+        self.record['duration'] = time.perf_counter() - self.started
+        self.write_record()
+        if METRICS_TEXTFILE_DIR:
+            self.write_textfile()
+
+    # Append to /tmp/<app>.org.render.metrics.jsonl, rotating it to .1 past METRICS_MAX_BYTES
+    def write_record(self):
+        path = f'/tmp/{self.app_name}.org.render.metrics.jsonl'
+        try:
+            if os.path.getsize(path) > METRICS_MAX_BYTES:
+                os.replace(path, f'{path}.1')
+        except FileNotFoundError:
+            pass
+        with open(path, 'a') as file:
+            file.write(json.dumps(self.record) + '\n')
+
+    def write_textfile(self):
+        record = self.record
+        labels = ','.join(f'{name}="{label_value(record[name])}"' for name in ['app', 'cluster', 'environment'])
+        lines = [
+            '# HELP org_render_duration_seconds Wall time of the last organisation render.',
+            '# TYPE org_render_duration_seconds gauge',
+            f'org_render_duration_seconds{{{labels}}} {record["duration"]}',
+            '# HELP org_render_phase_seconds Wall time of the last organisation render per phase.',
+            '# TYPE org_render_phase_seconds gauge',
+        ]
+        lines += [f'org_render_phase_seconds{{{labels},phase="{phase}"}} {seconds}' for phase, seconds in record['phases'].items()]
+        for kind in ['projects', 'applications']:
+            lines += [
+                f'# HELP org_render_{kind} {kind.capitalize()} scanned and emitted by the last organisation render.',
+                f'# TYPE org_render_{kind} gauge',
+            ]
+            lines += [f'org_render_{kind}{{{labels},state="{state}"}} {count}' for state, count in record[kind].items()]
+        lines += [
+            '# HELP org_render_cache_hit Whether the last organisation render was served from the render cache.',
+            '# TYPE org_render_cache_hit gauge',
+            f'org_render_cache_hit{{{labels}}} {int(record["cache"] == "hit")}',
+            '# HELP org_render_last_timestamp_seconds Time of the last organisation render.',
+            '# TYPE org_render_last_timestamp_seconds gauge',
+            f'org_render_last_timestamp_seconds{{{labels}}} {record["timestamp"]}',
+        ]
+
+        # Write atomically so the collector never reads a partial file
+        path = os.path.join(METRICS_TEXTFILE_DIR, f'org_render_{self.app_name}.prom')
+        fd, tmp_path = tempfile.mkstemp(dir=METRICS_TEXTFILE_DIR, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+# Render AppProjects and Applications of a cluster of the org tree in root as multi-document
+# YAML into the binary stream out
+def render(cluster_name, environment, index, parsed, out, metrics, root='.'):
+    # Load .organisation
+    logging.debug("Loading .organisation")
+    with metrics.phase('load_defaults'):
+        defaults = load_yaml(os.path.join(root, '.organisation'))
+
+    # Load environment configuration
+    with metrics.phase('load_environment'):
+        environment_data = load_yaml(os.path.join(root, 'environments', f'{environment}.yaml'))
+
+    with metrics.phase('scan_projects'):
+        cluster_apps, project_files = select(cluster_name, environment_data, index)
+
+    # Building happens lazily while emitting, so emit is the remainder after build
+    started = time.perf_counter()
+    emit(metrics.built(build(cluster_apps, project_files, environment, Resolver(defaults), parsed, root)), out)
+    metrics.add('emit', time.perf_counter() - started - metrics.record['phases'].get('build', 0))
+
+# Batch worker: render one cluster from the shared inputs, one string per document
+def render_batch_job(environment, cluster_name):
+    resolver, environments, index, parsed = BATCH
+    cluster_apps, project_files = select(cluster_name, environments[environment], index)
+    documents = build(cluster_apps, project_files, environment, resolver, parsed)
+    return [yaml.dump(document, Dumper=Dumper) for document in documents]
+
+# Render every cluster of every environment (or the given ones) on a process pool.
+# Shared inputs are parsed once and inherited by the forked workers.
+def batch(environments, output_dir, workers):
+    global BATCH
+    logging.basicConfig(level=logging.INFO, format=LOGFORMAT)
+
+    if not environments:
+        environments = sorted(f[:-len('.yaml')] for f in os.listdir('environments') if f.endswith('.yaml'))
+
+    defaults = load_yaml('.organisation')
+    environment_data = {environment: load_yaml(f'environments/{environment}.yaml') for environment in environments}
+
+    index_path = index_file(os.getenv('ARGOCD_APP_NAME'))
+    index = load_index(index_path)
+    parsed = update_index(index, index_path)
+    for project_file in index['projects']:
+        if project_file not in parsed:
+            parsed[project_file] = load_yaml(f'projects/{project_file}')
+
+    BATCH = (Resolver(defaults), environment_data, index, parsed)
+    jobs = [
+        (environment, cluster['name'])
+        for environment in environments
+        for cluster in environment_data[environment]['spec']['clusters']
+    ]
+    logging.info("Rendering %d clusters across %d environments", len(jobs), len(environments))
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+        futures = [pool.submit(render_batch_job, environment, cluster_name) for environment, cluster_name in jobs]
+        # Collect in submission order so the output is deterministic
+        for (environment, cluster_name), future in zip(jobs, futures):
+            documents = future.result()
+            if output_dir:
+                path = os.path.join(output_dir, environment, f'{cluster_name}.yaml')
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as file:
+                    for document in documents:
+                        file.write("---\n")
+                        file.write(document)
+                logging.info("Rendered %d documents to '%s'", len(documents), path)
+            else:
+                for document in documents:
+                    sys.stdout.write(f"---\n# cluster: {environment}/{cluster_name}\n")
+                    sys.stdout.write(document)
+
+# Render the org tree in root (the current directory by default) for a cluster and
+# environment into the binary stream out
+def generate(out, cluster_name, environment, app_name, root='.'):
+    logging.debug("ClusterName: '%s'", cluster_name)
+    logging.debug("Environment: '%s'", environment)
+
+    metrics = RenderMetrics(app_name, cluster_name, environment)
+    with metrics.phase('scan_projects'):
+        index_path = index_file(app_name)
+        index = load_index(index_path)
+        parsed = update_index(index, index_path, root)
+    metrics.scanned(index)
+
+    if not CACHE_ENABLED:
+        render(cluster_name, environment, index, parsed, out, metrics, root)
+    else:
+        with metrics.phase('cache_lookup'):
+            key = cache_key(cluster_name, environment, index, root)
+
+        started = time.perf_counter()
+        if cache_get(key, out):
+            metrics.add('emit', time.perf_counter() - started)
+            logging.debug("Render cache hit: '%s'", key)
+            metrics.record['cache'] = 'hit'
+        else:
+            logging.debug("Render cache miss: '%s'", key)
+            metrics.record['cache'] = 'miss'
+            with cache_put(key, out) as stream:
+                render(cluster_name, environment, index, parsed, stream, metrics, root)
+
+    try:
+        metrics.write()
+    except OSError:
+        logging.exception("Failed to write render metrics")
+
+# The ORG_RENDER_* settings of this process. The server reads them once, at start, so
+# generate.py sends its own with every request and the server only renders when they match.
+def render_settings():
+    return {key: value for key, value in os.environ.items() if key.startswith('ORG_RENDER_')}
+
+class RenderRequestHandler(socketserver.StreamRequestHandler):
+    # Request: one JSON line with cluster, environment, path, app and settings.
+    # Response: an 'accepted' JSON line once a thread picked the request up, then one JSON
+    # status line, followed by 'length' bytes of output when ok.
+    def handle(self):
+        output = io.BytesIO()
+        stale = False
+        try:
+            request = json.loads(self.rfile.readline())
+            logging.info("Render request: %s", {key: value for key, value in request.items() if key != 'settings'})
+            self.wfile.write(json.dumps({'status': 'accepted'}).encode() + b'\n')
+            self.wfile.flush()
+            if request.get('settings') != self.server.settings:
+                stale = True
+                raise ValueError("Render server settings differ from the request's, shutting down")
+            generate(output, request['cluster'], request['environment'], request['app'], request['path'])
+        except Exception as e:
+            logging.exception("Render request failed")
+            status = {'status': 'error', 'message': str(e)}
+        else:
+            status = {'status': 'ok', 'length': output.tell()}
+        self.wfile.write(json.dumps(status).encode() + b'\n')
+        if status['status'] == 'ok':
+            self.wfile.write(output.getvalue())
+        # The next generate starts a server with its settings
+        if stale:
+            self.server.shutdown()
+
+# One thread per request. Renders never change the working directory, and parsed
+# documents are shared by all requests.
+class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # A full Unix socket backlog refuses connections outright, sending generates in-process
+    request_queue_size = 128
+
+    def __init__(self, path):
+        super().__init__(path, RenderRequestHandler)
+        self.settings = render_settings()
+
+# Serve render requests over a Unix socket, keeping parsed documents in memory
+def serve():
+    global DOCUMENTS
+    logging.basicConfig(filename=SERVER_LOGFILE, level=LOGLEVEL, format=LOGFORMAT)
+
+    # Only one server per socket; late starters just leave
+    lock = open(f'{SERVER_SOCKET}.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logging.info("Render server already running on '%s'", SERVER_SOCKET)
+        return
+
+    DOCUMENTS = {}
+    if os.path.exists(SERVER_SOCKET):
+        os.remove(SERVER_SOCKET)
+    os.umask(0o077)
+    with RenderServer(SERVER_SOCKET) as server:
+        logging.info("Render server listening on '%s'", SERVER_SOCKET)
+        server.serve_forever()
+    # Without the socket, the next generate starts a new server
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(SERVER_SOCKET)
+
+def main():
+    logging.basicConfig(filename=LOGFILE, level=LOGLEVEL, format=LOGFORMAT)
+    # Current cluster name and environment from environment variables
+    generate(
+        sys.stdout.buffer,
+        os.getenv('CLUSTER_NAME'),
+        os.getenv('ARGOCD_ENV_ENVIRONMENT'),
+        os.getenv('ARGOCD_APP_NAME'),
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render organisation AppProjects and Applications')
+    parser.add_argument('--serve', action='store_true', help=f"run the render server on '{SERVER_SOCKET}'")
+    parser.add_argument('--batch', action='store_true', help="render every cluster of every environment")
+    parser.add_argument('--environment', action='append', help="limit --batch to this environment (repeatable)")
+    parser.add_argument('--output-dir', help="write --batch output to <dir>/<environment>/<cluster>.yaml instead of stdout")
+    parser.add_argument('--workers', type=int, help="--batch worker processes (default: CPU count)")
+    args = parser.parse_args()
+    if args.serve:
+        serve()
+    elif args.batch:
+        batch(args.environment, args.output_dir, args.workers)
+    else:
+        main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# Stand-in Vault and Kubernetes API servers for exercising resolve.py locally.
+#
+# Serves Vault Kubernetes-auth logins, KV v2 reads (with ?version=) and Secret/ConfigMap
+# GETs from in-memory data, over plain HTTP on localhost. Every request is counted by
+# (method, path), the most requests in flight at once is recorded, and latency and failing
+# first attempts can be injected per path.
+#
+# Not part of the plugin (the qts ConfigMap only ships plugin.yaml, the scripts and
+# resolve.py); used by test_resolve.py. Run on its own to point render.sh at it:
+#
+#   python fake_sources.py 8200
+
+import sys
+import json
+import time
+import base64
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN = 'fake-vault-token'
+
+# namespace/name -> data, as the fixtures under golden/ expect them
+CONFIGMAPS = {
+    'ns1/app': {
+        'host': 'db.internal',
+        'port': '5432',
+        'multi': 'line1\nline2\nline3',
+        'values': 'replicas: 2\nresources:\n  limits:\n    cpu: 1',
+        'list': '- a\n- b',
+        'encoded': 'd29ybGQ=',
+    },
+    'ns2/other': {'url': 'https://x.example/path'},
+}
+# Plain values, served base64-encoded like the API does
+SECRETS = {
+    'ns1/creds': {
+        'password': 's3cr3t-P4ss',
+        'b64': 'aGVsbG8=',
+        'cert': '-----BEGIN-----\nABC\nDEF\n-----END-----',
+    },
+}
+# (path, version) -> data; version '' is the latest
+VAULT = {
+    ('app/db', ''): {'user': 'admin', 'pass': 'vault-pw', 'config': 'a: 1\nb:\n  c: 2', 'num': 42},
+    ('app/db', '2'): {'user': 'admin-v2'},
+    ('app/other', ''): {'token': 'tok-123456789'},
+}
+
+class FakeSources:
+    def __init__(self, latency=0.0, failures=None):
+        self.latency = latency
+        # path -> number of first requests answered with a 500
+        self.failures = Counter(failures or {})
+        self.requests = Counter()
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    # Requests to paths starting with prefix
+    def count(self, method, prefix=''):
+        return sum(n for (m, path), n in self.requests.items() if m == method and path.startswith(prefix))
+
+    def start(self, port=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Status and body for a request
+    def respond(self, method, path, body):
+        with self.lock:
+            self.requests[(method, path)] += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            return self.answer(method, path, body)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def answer(self, method, path, body):
+        with self.lock:
+            if self.failures[path] > 0:
+                self.failures[path] -= 1
+                return 500, {'errors': ['injected failure']}
+        if method == 'POST' and path.startswith('/v1/auth/') and path.endswith('/login'):
+            if not (body or {}).get('jwt'):
+                return 400, {'errors': ['missing jwt']}
+            return 200, {'auth': {'client_token': TOKEN}}
+        if method != 'GET':
+            return 405, {}
+        if path.startswith('/v1/'):
+            return self.vault(path)
+        if path.startswith('/api/v1/namespaces/'):
+            return self.kubernetes(path)
+        return 404, {}
+
+    def vault(self, path):
+        # /v1/<backend>/data/service/<path>[?version=<n>]
+        path, _, version = path.partition('?version=')
+        _, _, secret = path.partition('/data/service/')
+        data = VAULT.get((secret, version))
+        if data is None:
+            return 404, {'errors': []}
+        return 200, {'data': {'data': data}}
+
+    def kubernetes(self, path):
+        # /api/v1/namespaces/<namespace>/<kind>s/<name>
+        parts = path.split('/')
+        if len(parts) != 7:
+            return 404, {'kind': 'Status', 'code': 404}
+        namespace, kind, name = parts[4], parts[5], parts[6]
+        if kind == 'configmaps':
+            data = CONFIGMAPS.get(f'{namespace}/{name}')
+        elif kind == 'secrets':
+            data = SECRETS.get(f'{namespace}/{name}')
+            if data is not None:
+                data = {key: base64.b64encode(value.encode()).decode() for key, value in data.items()}
+        else:
+            data = None
+        if data is None:
+            return 404, {'kind': 'Status', 'code': 404}
+        return 200, {'data': data}
+
+def handler(sources):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def reply(self, method):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or b'null') if length else None
+            status, response = sources.respond(method, self.path, body)
+            data = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.reply('GET')
+
+        def do_POST(self):
+            self.reply('POST')
+
+    return Handler
+
+if __name__ == '__main__':
+    sources = FakeSources().start(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    print(f'Serving Vault and Kubernetes on {sources.url}', flush=True)
+    threading.Event().wait()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+
+# Placeholder resolver for the qts plugin.
+#
+# Replaces $(vault:...), $(secret:...), $(configmap:...) and $(env:...) placeholders in a
+# rendered file. The file is tokenized once, every unique placeholder is resolved once, and
+# the result is written in a single pass and atomically, instead of one grep/sed/yq rewrite
+# of the whole file per placeholder. Vault is logged in to once per run, and each Vault
+# secret, Secret or ConfigMap is fetched once, distinct ones in parallel.
+#
+#   $(vault:<path>#<key>[#<version>][|<option>])
+#   $(secret:<namespace>/<name>#<key>[|<option>])
+#   $(configmap:<namespace>/<name>#<key>[|<option>])
+#   $(env:<NAME>[|<option>])       ARGOCD_ENV_<NAME>, or ARGOCD_APP_* as is
+#
+# Options: b64enc, b64dec, str, yaml (insert a multiline value as YAML) and trunc <N>.
+#
+# A value that cannot be resolved (a missing key, or Vault or Kubernetes still failing after
+# the retries) is replaced by null with a warning in the log, as render.sh did. Apps that
+# set the plugin env STRICT=true (ARGOCD_ENV_STRICT) fail the render instead.
+#
+# Usage: resolve.py <file>...
+
+import os
+import re
+import ssl
+import sys
+import json
+import time
+import base64
+import logging
+import tempfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import yaml
+
+LOGFILE=f'/tmp/{os.environ.get("ARGOCD_APP_NAME")}.qts.render.log'
+LOGFORMAT='%(asctime)s - [%(levelname)s]\t %(message)s'
+LOGLEVEL=logging.DEBUG if os.environ.get('ARGOCD_ENV_DEBUG') == 'true' else logging.INFO
+
+SA_TOKEN_FILE = '/var/run/secrets/kubernetes.io/serviceaccount/token'
+KUBERNETES_URL = 'https://kubernetes.default:443'
+# Attempts per request, like render.sh, with exponential backoff between them
+RETRIES = 6
+BACKOFF = 0.5
+BACKOFF_MAX = 8
+# Vault secrets, Secrets and ConfigMaps fetched in parallel
+WORKERS = int(os.environ.get('QTS_FETCH_WORKERS', 8))
+
+# Placeholders never contain '$', '(' or ')'; resource placeholders need a '#<key>'
+PLACEHOLDER = re.compile(r'\$\((vault|secret|configmap):([^$()\n]+?#[^$()\n]+)\)|\$\(env:([^$()\n]+)\)')
+
+# render.sh processed the types in this order
+TYPES = ['vault', 'secret', 'configmap', 'env']
+
+# The indentation, list dashes and key of a `key: value` or `- value` line
+LINE = re.compile(r'^(?P<lead>[ ]*(?:-[ ]+)*)(?P<key>(?:"[^"]*"|\'[^\']*\'|[^\s\'"#][^:]*?):(?:[ ]+|$))?(?P<value>.*?)(?P<end>[ \t]*\r?\n?)$')
+
+# TLS is not verified, like `curl -k` in render.sh
+INSECURE = ssl._create_unverified_context()
+
+class ResolveError(Exception):
+    pass
+
+# A request still failing after the retries
+class UnavailableError(ResolveError):
+    pass
+
+# A placeholder split like render.sh's getArgs: path#key#version|options
+class Placeholder:
+    def __init__(self, kind, string):
+        self.kind = kind
+        self.string = string
+        self.text = f'$({kind}:{string})'
+        # Only the second '|' field is an option, like `cut -d'|' -f2`
+        self.options = string.split('|')[1] if '|' in string else ''
+        fields = string.split('#')
+        self.path = fields[0]
+        self.key = fields[1].split('|')[0] if len(fields) > 1 else ''
+        self.version = fields[2].split('|')[0] if len(fields) > 2 else ''
+        # Namespace up to the last '/', name after the first one (grep -Po in render.sh)
+        self.namespace = self.path.rsplit('/', 1)[0] if '/' in self.path else ''
+        self.name = self.path.split('/', 1)[1] if '/' in self.path else ''
+
+def http_json(url, token, data=None):
+    request = urllib.request.Request(url, headers={'Authorization': f'Bearer {token}'} if token else {})
+    if data is not None:
+        request.data = json.dumps(data).encode()
+        request.method = 'POST'
+    try:
+        with urllib.request.urlopen(request, context=INSECURE, timeout=30) as response:
+            return json.loads(response.read() or b'null')
+    except urllib.error.HTTPError as e:
+        # Error bodies are JSON too, and logged by the caller
+        try:
+            return json.loads(e.read() or b'null')
+        except ValueError:
+            return None
+    except (OSError, ValueError) as e:
+        logging.warning(f'Request to {url} failed: {e}')
+        return None
+
+def require(variable):
+    if not os.environ.get(variable):
+        raise ResolveError(f'{variable} must be set')
+    return os.environ[variable]
+
+# Values are printed the way yq prints them: strings raw, other scalars as YAML, structures as YAML blocks
+def to_text(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return yaml.safe_dump(value, default_flow_style=False, sort_keys=False)
+    return json.dumps(value)
+
+# Call request() until accept() returns something for its response, backing off exponentially
+def with_retries(what, request, accept):
+    for attempt in range(RETRIES):
+        if attempt:
+            time.sleep(min(BACKOFF * 2 ** (attempt - 1), BACKOFF_MAX))
+        logging.info(f'{what} [{attempt}]')
+        response = request()
+        result = accept(response)
+        if result is not None:
+            return result
+        logging.warning(f'{what} failed: {response}')
+    raise UnavailableError(f'{what} failed. Sent logs to {LOGFILE}')
+
+# Reads placeholder values. Vault is logged in to once, and each object (a Vault secret
+# version, a Secret or a ConfigMap) is fetched once however many of its keys are used.
+# Unless strict, values that cannot be read are null.
+class Sources:
+    def __init__(self, strict=False):
+        self.strict = strict
+        self.vault_token = None
+        self.vault_error = None
+        self.sa_token = None
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def vault_login(self):
+        with self.lock:
+            # A failed login is not retried for every Vault secret
+            if self.vault_error is not None:
+                raise self.vault_error
+            if self.vault_token is None:
+                addr = require('VAULT_ADDR')
+                backend = require('VAULT_AUTH_BACKEND')
+                jwt = self.service_account_token()
+                try:
+                    self.vault_token = with_retries(
+                        'Auth to Vault',
+                        lambda: http_json(f'{addr}/v1/auth/{backend}/login', None, {'jwt': jwt, 'role': 'argo'}),
+                        lambda response: ((response or {}).get('auth') or {}).get('client_token'),
+                    )
+                except UnavailableError as e:
+                    self.vault_error = e
+                    raise
+        return self.vault_token
+
+    def service_account_token(self):
+        if self.sa_token is None:
+            with open(SA_TOKEN_FILE) as file:
+                self.sa_token = file.read().strip()
+        return self.sa_token
+
+    # The object a placeholder reads its key from
+    @staticmethod
+    def object_key(placeholder):
+        if placeholder.kind == 'vault':
+            return ('vault', placeholder.path, placeholder.version)
+        return (placeholder.kind, placeholder.namespace, placeholder.name)
+
+    def fetch(self, key):
+        if key[0] == 'vault':
+            _, path, version = key
+            token = self.vault_login()
+            url = f'{require("VAULT_ADDR")}/v1/{require("VAULT_SECRET_BACKEND")}/data/service/{path}'
+            if version:
+                url += f'?version={version}'
+            return with_retries(
+                f'Retrieving {path} from Vault',
+                lambda: http_json(url, token),
+                lambda response: ((response or {}).get('data') or {}).get('data'),
+            )
+        kind, namespace, name = key
+        token = self.service_account_token()
+        url = f'{KUBERNETES_URL}/api/v1/namespaces/{namespace}/{kind}s/{name}'
+        return with_retries(
+            f'Retrieving {kind} {namespace}/{name} from Kubernetes',
+            lambda: http_json(url, token),
+            lambda response: (response or {}).get('data'),
+        )
+
+    # The object, or None if it cannot be read and the render is not strict
+    def load(self, key):
+        try:
+            return self.fetch(key)
+        except UnavailableError as e:
+            if self.strict:
+                raise
+            logging.warning(f'{e} Its values are replaced by null')
+            return None
+
+    # Fetch the objects behind the placeholders, distinct ones in parallel
+    def prefetch(self, placeholders):
+        keys = [key for key in dict.fromkeys(self.object_key(p) for p in placeholders if p.kind != 'env') if key not in self.objects]
+        if not keys:
+            return
+        if any(key[0] == 'vault' for key in keys):
+            try:
+                self.vault_login()
+            except UnavailableError:
+                # Reported by load() for each Vault secret
+                if self.strict:
+                    raise
+        with ThreadPoolExecutor(max_workers=min(WORKERS, len(keys))) as pool:
+            futures = {pool.submit(self.load, key): key for key in keys}
+            for future in as_completed(futures):
+                if future.exception():
+                    for pending in futures:
+                        pending.cancel()
+                    raise future.exception()
+                self.objects[futures[future]] = future.result()
+
+    def lookup(self, placeholder):
+        key = self.object_key(placeholder)
+        if key not in self.objects:
+            self.objects[key] = self.load(key)
+        data = self.objects[key] or {}
+        value = data.get(placeholder.key)
+        if value is None or value == '':
+            logging.warning(f"VALUE '{placeholder.string}' is null, keys: {sorted(data)}")
+            if self.strict:
+                raise ResolveError(f"VALUE '{placeholder.string}' is null. Sent logs to {LOGFILE}")
+            # What render.sh was left with once its retries ran out
+            return 'null' if value is None else ''
+        value = to_text(value)
+        # Automatically decode base64 if resource type is secrets
+        if placeholder.kind == 'secret':
+            value = base64.b64decode(value).decode()
+            logging.info(f'Automatically decoded secret value for {placeholder.key}')
+        return value
+
+    def env(self, placeholder):
+        name = placeholder.string.split('|')[0]
+        variable = name if name.startswith('ARGOCD_APP_') else f'ARGOCD_ENV_{name}'
+        return os.environ.get(variable) or f'{placeholder.string} is not defined'
+
+    def get(self, placeholder):
+        value = self.env(placeholder) if placeholder.kind == 'env' else self.lookup(placeholder)
+        # Shell command substitution drops trailing newlines
+        return apply_options(value.rstrip('\n'), placeholder.options)
+
+# The pipe options of render.sh
+def apply_options(value, option):
+    if not option:
+        return value
+    logging.info(f'Options detected: {option}')
+    if option == 'b64enc':
+        return base64.b64encode(value.encode()).decode()
+    if option == 'b64dec':
+        return base64.b64decode(value).decode().rstrip('\n')
+    if option == 'str':
+        return f'"{value}"'
+    if option == 'yaml':
+        logging.info('Using yaml option for value')
+        return value
+    if option.startswith('trunc'):
+        length = option[len('trunc '):] if option.startswith('trunc ') else option
+        if not re.fullmatch(r'-?[0-9]+', length):
+            logging.error('Invalid length for trunc option')
+            return value
+        length = int(length)
+        if length >= 0:
+            return value[:length]
+        # Like ${VALUE:-N}: empty when the value is shorter than N
+        return value[length:] if -length <= len(value) else ''
+    return value
+
+# Unique placeholders of the file, in render.sh's type order
+def scan(text):
+    found = {}
+    for match in PLACEHOLDER.finditer(text):
+        if match.group(1):
+            placeholder = Placeholder(match.group(1), match.group(2))
+        else:
+            placeholder = Placeholder('env', match.group(3))
+        found.setdefault(placeholder.text, placeholder)
+    return sorted(found.values(), key=lambda p: (TYPES.index(p.kind), p.string))
+
+# Replace a `yaml` placeholder's line with the value as YAML, indented to fit
+def splice_yaml(line, placeholder, value):
+    indent = len(line) - len(line.lstrip(' '))
+    alone = line.replace(' ', '').rstrip('\r\n') == placeholder.text
+    lines = []
+    if not alone:
+        # The placeholder is the value of a key: keep the key, nest the content under it
+        lines.append(line[:line.index(':') + 1] + '\n')
+        indent += 2
+    for content_line in value.split('\n'):
+        lines.append(' ' * indent + content_line + '\n')
+    return lines
+
+# Substitute a line's placeholders. Multiline values that are not inserted as YAML are
+# placed inside the scalar holding them, as render.sh did with yq.
+def substitute(line, values):
+    multiline = [p for p in PLACEHOLDER.finditer(line) if '\n' in values[p.group(0)]]
+
+    def single(match):
+        value = values[match.group(0)]
+        return match.group(0) if '\n' in value else value
+
+    line = PLACEHOLDER.sub(single, line)
+    if not multiline:
+        return line
+
+    def raw(match):
+        return values.get(match.group(0), match.group(0))
+
+    parts = LINE.match(line)
+    lead, key, value, end = parts.group('lead'), parts.group('key'), parts.group('value'), parts.group('end')
+    if not key and not lead.strip():
+        # A line of a block scalar: continuation lines keep its indentation
+        indent = lead + value[:len(value) - len(value.lstrip(' '))]
+        return PLACEHOLDER.sub(lambda m: raw(m).replace('\n', '\n' + indent), line)
+    if value.startswith('"') and value.endswith('"') and len(value) > 1:
+        escaped = PLACEHOLDER.sub(lambda m: json.dumps(raw(m), ensure_ascii=False)[1:-1], value)
+        return f'{lead}{key or ""}{escaped}{end}'
+    comment = ''
+    if value.startswith("'") and value.endswith("'") and len(value) > 1:
+        value = value[1:-1].replace("''", "'")
+    else:
+        # A plain scalar ends at a comment
+        last = list(PLACEHOLDER.finditer(value))[-1].end()
+        found = re.search(r'\s+#', value[last:])
+        if found:
+            value, comment = value[:last + found.start()], value[last + found.start():]
+    scalar = PLACEHOLDER.sub(raw, value)
+    return f'{lead}{key or ""}{json.dumps(scalar, ensure_ascii=False)}{comment}{end}'
+
+def valid_yaml(text):
+    try:
+        for _ in yaml.safe_load_all(text):
+            pass
+        return True
+    except yaml.YAMLError:
+        return False
+
+# Resolve every placeholder of the text in one pass
+def resolve(text, sources):
+    values = {}
+    splices = {}
+    placeholders = [p for p in scan(text) if p.kind != 'vault' or os.environ.get('VAULT_ADDR')]
+    sources.prefetch(placeholders)
+    for placeholder in placeholders:
+        logging.info(f"[{placeholder.kind}]: Replacing '{placeholder.string}'")
+        value = sources.get(placeholder)
+        values[placeholder.text] = value
+        # `yaml` placeholders with multiline values replace every line holding them
+        if placeholder.options == 'yaml' and '\n' in value:
+            if valid_yaml(value):
+                splices[placeholder.text] = (placeholder, value)
+            else:
+                logging.error(f"YAML content for '{placeholder.string}' is not valid, leaving the placeholder")
+                values[placeholder.text] = placeholder.text
+    if not values:
+        return text
+
+    output = []
+    for line in text.splitlines(keepends=True):
+        if '$(' not in line:
+            output.append(line)
+            continue
+        spliced = next((key for key in splices if key in line), None)
+        if spliced:
+            output.extend(splice_yaml(line, *splices[spliced]))
+            continue
+        known = {key: value for key, value in values.items() if key in line}
+        output.append(substitute(line, known) if known else line)
+    return ''.join(output)
+
+# Write next to the target and rename over it, so readers never see a partial file
+def write_atomic(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.resolve-', delete=False) as file:
+        file.write(text)
+    os.chmod(file.name, os.stat(path).st_mode & 0o777)
+    os.replace(file.name, path)
+
+def main():
+    logging.basicConfig(filename=LOGFILE, format=LOGFORMAT, datefmt='%Y-%m-%d %H:%M:%S', level=LOGLEVEL)
+    if not os.environ.get('VAULT_ADDR'):
+        logging.warning('Vault is not enabled. Skipping vault placeholders')
+    sources = Sources(strict=os.environ.get('ARGOCD_ENV_STRICT') == 'true')
+    for path in sys.argv[1:]:
+        with open(path) as file:
+            text = file.read()
+        try:
+            resolved = resolve(text, sources)
+        except ResolveError as e:
+            logging.error(str(e))
+            return 1
+        if resolved != text:
+            write_atomic(path, resolved)
+        logging.info(f'Placeholders resolved: {path}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+# Tests for resolve.py, run against the stand-in Vault and Kubernetes servers of
+# fake_sources.py, which count the requests they get. Not part of the plugin.
+#
+# golden/input holds values files and golden/expected what render.sh made of them before
+# resolve.py replaced its placeholder functions (same fake_sources.py data, same
+# environment as ENVIRONMENT below). Where resolve.py deliberately differs, the test
+# below says so.
+#
+#   python -m unittest test_resolve     (or pytest, from this directory)
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import resolve
+from fake_sources import FakeSources
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+# render.sh rewrote files with multiline values through yq, which reformats the whole file
+REFORMATTED = {'multiline.yaml'}
+
+ENVIRONMENT = {
+    'ARGOCD_APP_NAME': 'golden',
+    'ARGOCD_ENV_NAMESPACE': 'team-a',
+    'ARGOCD_ENV_FLAG': 'yes',
+    'VAULT_AUTH_BACKEND': 'kube',
+    'VAULT_SECRET_BACKEND': 'secret',
+}
+
+class ResolveTest(unittest.TestCase):
+    def setUp(self):
+        self.sources = FakeSources().start()
+        self.addCleanup(self.sources.stop)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        token = os.path.join(self.directory, 'token')
+        with open(token, 'w') as file:
+            file.write('fake-service-account-token\n')
+        environment = dict(ENVIRONMENT, VAULT_ADDR=self.sources.url)
+        for patch in [
+            mock.patch.dict(os.environ, environment),
+            mock.patch.object(resolve, 'KUBERNETES_URL', self.sources.url),
+            mock.patch.object(resolve, 'SA_TOKEN_FILE', token),
+            mock.patch.object(resolve, 'LOGFILE', os.path.join(self.directory, 'render.log')),
+            mock.patch.object(resolve, 'BACKOFF', 0),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        os.environ.pop('ARGOCD_ENV_NOT_SET', None)
+        os.environ.pop('ARGOCD_ENV_STRICT', None)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as file:
+            file.write(text)
+        return path
+
+    def read(self, path):
+        with open(path) as file:
+            return file.read()
+
+    # Run resolve.py on the files, as render.sh does
+    def render(self, *paths):
+        with mock.patch.object(sys, 'argv', ['resolve.py', *paths]):
+            return resolve.main()
+
+    def test_golden(self):
+        names = sorted(os.listdir(os.path.join(GOLDEN, 'input')))
+        self.assertTrue(names)
+        for name in names:
+            with self.subTest(name):
+                path = os.path.join(self.directory, name)
+                shutil.copyfile(os.path.join(GOLDEN, 'input', name), path)
+                self.assertEqual(self.render(path), 0)
+                resolved = self.read(path)
+                expected = self.read(os.path.join(GOLDEN, 'expected', name))
+                self.assertEqual(list(yaml.safe_load_all(resolved)), list(yaml.safe_load_all(expected)))
+                if name not in REFORMATTED:
+                    self.assertEqual(resolved, expected)
+
+    def test_repeated_yaml_placeholder_is_spliced_everywhere(self):
+        path = self.write('values.yaml', (
+            'first:\n'
+            '  $(configmap:ns1/app#values|yaml)\n'
+            'second: $(configmap:ns1/app#values|yaml)\n'
+            'list:\n'
+            '  - $(configmap:ns1/app#host)\n'
+        ))
+        self.assertEqual(self.render(path), 0)
+        spliced = {'replicas': 2, 'resources': {'limits': {'cpu': 1}}}
+        self.assertEqual(yaml.safe_load(self.read(path)), {
+            'first': spliced,
+            'second': spliced,
+            'list': ['db.internal'],
+        })
+
+    # render.sh skipped these: its greedy grep matched up to the last ')' of the line
+    def test_line_with_several_placeholders(self):
+        path = self.write('values.yaml', 'again: $(vault:app/db#pass) and $(env:NAMESPACE)\n')
+        self.assertEqual(self.render(path), 0)
+        self.assertEqual(self.read(path), 'again: vault-pw and team-a\n')
+
+    # render.sh inserted "null" once its retries ran out, and so does resolve.py by default
+    def test_missing_value_is_null(self):
+        path = self.write('values.yaml', 'host: $(configmap:ns1/app#host)\nmissing: $(configmap:ns1/app#nope)\n')
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertEqual(self.render(path), 0)
+        self.assertEqual(self.read(path), 'host: db.internal\nmissing: null\n')
+        self.assertIn("VALUE 'ns1/app#nope' is null", '\n'.join(logs.output))
+
+    def test_missing_value_fails_a_strict_render(self):
+        os.environ['ARGOCD_ENV_STRICT'] = 'true'
+        text = 'host: $(configmap:ns1/app#host)\nmissing: $(configmap:ns1/app#nope)\n'
+        path = self.write('values.yaml', text)
+        with self.assertLogs(level='ERROR') as logs:
+            self.assertEqual(self.render(path), 1)
+        self.assertEqual(self.read(path), text)
+        self.assertIn("VALUE 'ns1/app#nope' is null", logs.output[-1])
+
+    def test_vault_placeholders_are_kept_without_vault(self):
+        os.environ.pop('VAULT_ADDR')
+        path = self.write('values.yaml', 'user: $(vault:app/db#user)\nhost: $(configmap:ns1/app#host)\n')
+        self.assertEqual(self.render(path), 0)
+        self.assertEqual(self.read(path), 'user: $(vault:app/db#user)\nhost: db.internal\n')
+        self.assertEqual(self.sources.count('POST'), 0)
+
+    def test_one_login_and_one_fetch_per_object(self):
+        first = self.write('first.yaml', (
+            'user: $(vault:app/db#user)\n'
+            'pass: $(vault:app/db#pass|b64enc)\n'
+            'old: $(vault:app/db#user#2)\n'
+            'host: $(configmap:ns1/app#host)\n'
+            'port: $(configmap:ns1/app#port)\n'
+            'password: $(secret:ns1/creds#password)\n'
+        ))
+        second = self.write('second.yaml', (
+            'token: $(vault:app/other#token)\n'
+            'num: $(vault:app/db#num)\n'
+            'url: postgres://$(configmap:ns1/app#host):$(configmap:ns1/app#port)\n'
+            'hello: $(secret:ns1/creds#b64|b64dec)\n'
+        ))
+        self.assertEqual(self.render(first, second), 0)
+        self.assertEqual(self.sources.count('POST'), 1)
+        self.assertEqual(self.sources.count('POST', '/v1/auth/kube/login'), 1)
+        self.assertEqual(dict(self.sources.requests), {
+            ('POST', '/v1/auth/kube/login'): 1,
+            ('GET', '/v1/secret/data/service/app/db'): 1,
+            ('GET', '/v1/secret/data/service/app/db?version=2'): 1,
+            ('GET', '/v1/secret/data/service/app/other'): 1,
+            ('GET', '/api/v1/namespaces/ns1/configmaps/app'): 1,
+            ('GET', '/api/v1/namespaces/ns1/secrets/creds'): 1,
+        })
+        self.assertEqual(self.read(second), 'token: tok-123456789\nnum: 42\nurl: postgres://db.internal:5432\nhello: hello\n')
+
+    def test_failed_requests_are_retried(self):
+        self.sources.failures.update({
+            '/v1/auth/kube/login': 2,
+            '/api/v1/namespaces/ns1/configmaps/app': 3,
+        })
+        path = self.write('values.yaml', 'user: $(vault:app/db#user)\nhost: $(configmap:ns1/app#host)\n')
+        self.assertEqual(self.render(path), 0)
+        self.assertEqual(self.read(path), 'user: admin\nhost: db.internal\n')
+        self.assertEqual(self.sources.count('POST'), 3)
+        self.assertEqual(self.sources.count('GET', '/api/v1/namespaces/ns1/configmaps/app'), 4)
+        self.assertEqual(self.sources.count('GET', '/v1/'), 1)
+
+    def test_retries_give_up(self):
+        path = self.write('values.yaml', 'host: $(configmap:ns1/missing#host)\nsecret: $(secret:ns1/missing#key)\n')
+        self.assertEqual(self.render(path), 0)
+        self.assertEqual(self.read(path), 'host: null\nsecret: null\n')
+        self.assertEqual(self.sources.count('GET', '/api/v1/namespaces/ns1/configmaps/missing'), resolve.RETRIES)
+
+    def test_retries_give_up_in_a_strict_render(self):
+        os.environ['ARGOCD_ENV_STRICT'] = 'true'
+        path = self.write('values.yaml', 'host: $(configmap:ns1/missing#host)\n')
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(self.render(path), 1)
+        self.assertEqual(self.sources.count('GET'), resolve.RETRIES)
+
+    # Vault secrets are null, and the login is not retried for each of them
+    def test_failed_vault_login(self):
+        self.sources.failures['/v1/auth/kube/login'] = resolve.RETRIES
+        path = self.write('values.yaml', (
+            'user: $(vault:app/db#user)\n'
+            'token: $(vault:app/other#token)\n'
+            'host: $(configmap:ns1/app#host)\n'
+        ))
+        self.assertEqual(self.render(path), 0)
+        self.assertEqual(self.read(path), 'user: null\ntoken: null\nhost: db.internal\n')
+        self.assertEqual(self.sources.count('POST'), resolve.RETRIES)
+        self.assertEqual(self.sources.count('GET', '/v1/'), 0)
+
+    def test_distinct_objects_are_fetched_in_parallel(self):
+        self.sources.latency = 0.2
+        path = self.write('values.yaml', (
+            'a: $(vault:app/db#user)\n'
+            'b: $(vault:app/db#user#2)\n'
+            'c: $(vault:app/other#token)\n'
+            'd: $(configmap:ns1/app#host)\n'
+            'e: $(configmap:ns2/other#url)\n'
+            'f: $(secret:ns1/creds#password)\n'
+        ))
+        with mock.patch.object(resolve, 'WORKERS', 3):
+            started = time.monotonic()
+            self.assertEqual(self.render(path), 0)
+            elapsed = time.monotonic() - started
+        # The login, then six objects three at a time: 3 x 0.2s instead of 7 x 0.2s
+        self.assertEqual(self.sources.peak, 3)
+        self.assertLess(elapsed, 1.2)
+
+if __name__ == '__main__':
+    unittest.main()
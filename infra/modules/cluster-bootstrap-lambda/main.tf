@@ -12,6 +12,12 @@ locals {
   function_name = "${var.name_prefix}-eks-bootstrap"
 }
 
+# Keys the desired-state hashes stamped on Secrets, so they reveal nothing about the values
+resource "random_password" "hash_key" {
+  length  = 48
+  special = false
+}
+
 data "archive_file" "lambda" {
   type        = "zip"
   source_dir  = "${path.module}/package"
@@ -42,7 +48,8 @@ resource "aws_lambda_function" "bootstrap" {
   # Environment
   environment {
     variables = {
-      LOG_LEVEL = "INFO"
+      LOG_LEVEL          = "INFO"
+      BOOTSTRAP_HASH_KEY = random_password.hash_key.result
     }
   }
 
@@ -110,6 +117,23 @@ data "aws_iam_policy_document" "lambda_eks" {
     }
   }
 
+  # Batch reads (no resource-level permissions; each secret still needs GetSecretValue above)
+  statement {
+    effect    = "Allow"
+    actions   = ["secretsmanager:BatchGetSecretValue"]
+    resources = ["*"]
+  }
+
+  # Manifest bundles referenced by s3:// URIs
+  dynamic "statement" {
+    for_each = length(var.manifest_bucket_arns) > 0 ? [1] : []
+    content {
+      effect    = "Allow"
+      actions   = ["s3:GetObject"]
+      resources = [for arn in var.manifest_bucket_arns : "${arn}/*"]
+    }
+  }
+
   # STS for EKS authentication
   statement {
     effect    = "Allow"
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+"""
+Bootstrap Lambda benchmark
+
+Drives handler() end to end against the fake API server in fake_kube.py, for synthetic
+ArgoCD installs of 100, 500 and 2,000 manifests. AWS is stubbed at the client cache
+(describe_cluster, Secrets Manager) and the EKS token is signed with dummy credentials,
+so everything else runs as it would in Lambda. Each scenario is run as a fresh install
+and again unchanged, reporting wall time and API requests by verb. Results can be saved
+as a baseline and later runs compared against it, failing on regressions.
+
+The peak memory of parsing a large gzipped bundle read from (stubbed) S3 is measured
+too, and fails the run if parsing holds much more than the parsed result, which would
+mean the bundle is no longer streamed.
+
+    python3 benchmark.py --save-baseline baseline.json
+    python3 benchmark.py --baseline baseline.json --threshold 0.2
+    python3 benchmark.py --scenario 500 --latency 0.01 --crd-delay 2
+    python3 benchmark.py --scenario 100 --bundle-mb 50 --max-bundle-overhead 0.1
+"""
+
+import argparse
+import base64
+import contextlib
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+# Never sign with real credentials or reach AWS
+os.environ.update({
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "AWS_DEFAULT_REGION": "eu-central-1",
+})
+os.environ.pop("AWS_PROFILE", None)
+
+import handler
+from fake_kube import FakeKubeServer
+
+REGION = "eu-central-1"
+CLUSTER_NAME = "benchmark"
+SECRETS = 5
+
+# name: manifests
+SCENARIOS = {
+    "100": 100,
+    "500": 500,
+    "2000": 2000,
+}
+
+RUNS = ["install", "unchanged"]
+
+# Runs faster than this are timer noise and never count as regressions
+NOISE_FLOOR_SECONDS = 0.05
+
+BUNDLE_URI = "s3://benchmark/bundle.yaml.gz"
+
+
+class FakeEKS:
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+
+    def describe_cluster(self, name: str) -> dict:
+        return {
+            "cluster": {
+                "endpoint": self.endpoint,
+                # Never read: the fake server is plain HTTP
+                "certificateAuthority": {"data": base64.b64encode(b"benchmark").decode()},
+            }
+        }
+
+
+class FakeSecretsManager:
+    def __init__(self, secrets: dict):
+        self.secrets = secrets
+
+    def batch_get_secret_value(self, SecretIdList: list) -> dict:
+        return {
+            "SecretValues": [
+                {"ARN": arn, "Name": arn.split(":")[-1], "SecretString": self.secrets[arn]}
+                for arn in SecretIdList
+            ],
+            "Errors": [],
+        }
+
+    def get_secret_value(self, SecretId: str) -> dict:
+        return {"ARN": SecretId, "SecretString": self.secrets[SecretId]}
+
+
+class FakeS3:
+    def __init__(self, objects: dict):
+        # (bucket, key): local file
+        self.objects = objects
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        # A file streams like the StreamingBody boto3 returns
+        return {"Body": open(self.objects[(Bucket, Key)], "rb")}
+
+
+def crd(group: str, kind: str, plural: str) -> dict:
+    return {
+        "apiVersion": "apiextensions.k8s.io/v1",
+        "kind": "CustomResourceDefinition",
+        "metadata": {"name": f"{plural}.{group}"},
+        "spec": {
+            "group": group,
+            "scope": "Namespaced",
+            "names": {"plural": plural, "kind": kind, "singular": kind.lower()},
+            "versions": [{"name": "v1alpha1", "served": True, "storage": True}],
+        },
+    }
+
+
+def component(i: int) -> list:
+    """The core objects of one ArgoCD component: a Deployment and what it references."""
+    metadata = lambda name: {"name": name, "namespace": "argocd"}
+    return [
+        {"apiVersion": "v1", "kind": "ServiceAccount", "metadata": metadata(f"component-{i}")},
+        {"apiVersion": "v1", "kind": "ConfigMap", "metadata": metadata(f"component-{i}-config"), "data": {"index": str(i)}},
+        {"apiVersion": "v1", "kind": "Secret", "metadata": metadata(f"component-{i}-secret"), "stringData": {"index": str(i)}},
+        {"apiVersion": "v1", "kind": "Service", "metadata": metadata(f"component-{i}"), "spec": {"ports": [{"port": 8080}]}},
+        {
+            "apiVersion": "rbac.authorization.k8s.io/v1",
+            "kind": "ClusterRole",
+            "metadata": {"name": f"component-{i}"},
+            "rules": [{"apiGroups": [""], "resources": ["configmaps"], "verbs": ["get"]}],
+        },
+        {
+            "apiVersion": "rbac.authorization.k8s.io/v1",
+            "kind": "ClusterRoleBinding",
+            "metadata": {"name": f"component-{i}"},
+            "roleRef": {"apiGroup": "rbac.authorization.k8s.io", "kind": "ClusterRole", "name": f"component-{i}"},
+            "subjects": [{"kind": "ServiceAccount", "name": f"component-{i}", "namespace": "argocd"}],
+        },
+        {
+            "apiVersion": "apps/v1",
+            "kind": "Deployment",
+            "metadata": metadata(f"component-{i}"),
+            "spec": {
+                "replicas": 1,
+                "template": {
+                    "spec": {
+                        "serviceAccountName": f"component-{i}",
+                        "volumes": [
+                            {"name": "config", "configMap": {"name": f"component-{i}-config"}},
+                            {"name": "secret", "secret": {"secretName": f"component-{i}-secret"}},
+                        ],
+                        "containers": [{"name": "main", "image": "quay.io/argoproj/argocd:v2.13.0"}],
+                    }
+                },
+            },
+        },
+    ]
+
+
+def generate_event(manifests: int) -> dict:
+    """
+    A bootstrap event with about `manifests` objects, split like a real install:
+    CRDs and the namespace first, core objects for half of the rest, Applications after.
+    """
+    p0 = [
+        crd("argoproj.io", "Application", "applications"),
+        crd("argoproj.io", "AppProject", "appprojects"),
+        crd("argoproj.io", "ApplicationSet", "applicationsets"),
+        {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": "argocd"}},
+    ]
+    p1 = []
+    while len(p1) < (manifests - len(p0)) // 2:
+        p1 += component(len(p1) // 7)
+    p2 = [{"apiVersion": "argoproj.io/v1alpha1", "kind": "AppProject", "metadata": {"name": "default", "namespace": "argocd"}, "spec": {}}]
+    p2 += [
+        {
+            "apiVersion": "argoproj.io/v1alpha1",
+            "kind": "Application",
+            "metadata": {"name": f"app-{i}", "namespace": "argocd"},
+            "spec": {"project": "default", "source": {"path": f"apps/app-{i}"}},
+        }
+        for i in range(manifests - len(p0) - len(p1) - 1)
+    ]
+    return {
+        "cluster_name": CLUSTER_NAME,
+        "region": REGION,
+        "argocd_manifests_p0": [yaml.safe_dump_all(p0)],
+        "argocd_manifests_p1": [yaml.safe_dump_all(p1)],
+        "argocd_manifests_p2": [yaml.safe_dump_all(p2)],
+        "secrets": [
+            {"arn": f"arn:aws:secretsmanager:{REGION}:000000000000:secret:benchmark-{i}", "name": f"benchmark-{i}"}
+            for i in range(SECRETS)
+        ],
+        "cluster_config": {"cluster_name": CLUSTER_NAME, "environment": "benchmark"},
+    }
+
+
+def write_bundle(path: str, megabytes: float) -> int:
+    """
+    Write a gzipped bundle of about `megabytes` of YAML: components whose ConfigMaps hold
+    dashboard-like JSON, the bulk of a real install. Returns the uncompressed size.
+    """
+    rng = random.Random(0)
+    size = 0
+    i = 0
+    with gzip.open(path, "wt") as file:
+        while size < megabytes * 1024 * 1024:
+            documents = component(i)
+            documents[1]["data"] = {
+                f"dashboard-{d}.json": json.dumps({
+                    "panels": [
+                        {"id": p, "title": f"panel {rng.randrange(10**6)}", "expr": f"rate(metric_{rng.randrange(500)}[5m])"}
+                        for p in range(40)
+                    ]
+                })
+                for d in range(3)
+            }
+            text = yaml.safe_dump_all(documents, explicit_start=True)
+            file.write(text)
+            size += len(text)
+            i += 1
+    return size
+
+
+def measure_bundle(megabytes: float) -> dict:
+    """Peak traced memory of parse_manifests on a gzipped bundle read from S3."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bundle.yaml.gz")
+        size = write_bundle(path, megabytes)
+        handler._aws_clients[("s3", None)] = FakeS3({("benchmark", "bundle.yaml.gz"): path})
+        tracemalloc.start()
+        started = time.perf_counter()
+        bundle = handler.parse_manifests([], [{"uri": BUNDLE_URI}], [])
+        seconds = time.perf_counter() - started
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            "bytes": size,
+            "gzip_bytes": os.path.getsize(path),
+            "documents": len(bundle["summaries"]),
+            "seconds": seconds,
+            "peak": peak,
+            # What parse_manifests returns is kept for applying; the rest is transient
+            "retained": retained,
+            "overhead": (peak - retained) / size,
+        }
+
+
+def reset_handler(endpoint: str, secrets: dict) -> None:
+    """Start from a cold execution environment, with stubbed AWS clients."""
+    handler._cluster_info.clear()
+    handler._eks_auth.clear()
+    handler._aws_clients.clear()
+    handler._aws_clients[("eks", REGION)] = FakeEKS(endpoint)
+    handler._aws_clients[("secretsmanager", REGION)] = FakeSecretsManager(secrets)
+    handler._cold_start = True
+
+
+def run_scenario(manifests: int, repeat: int, server_options: dict) -> dict:
+    """Best of `repeat` install + unchanged runs, each pair against a fresh server."""
+    event = generate_event(manifests)
+    secrets = {entry["arn"]: json.dumps({"token": entry["arn"]}) for entry in event["secrets"]}
+    best: dict = {}
+    for _ in range(repeat):
+        with FakeKubeServer(**server_options) as server:
+            reset_handler(server.url, secrets)
+            for run in RUNS:
+                before = dict(server.state.requests)
+                started = time.perf_counter()
+                # EMF records go to stdout; keep the report readable
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results = handler.handler(event, None)
+                seconds = time.perf_counter() - started
+                requests = {
+                    verb: count - before.get(verb, 0)
+                    for verb, count in server.state.requests.items()
+                    if count - before.get(verb, 0)
+                }
+                if run not in best or seconds < best[run]["seconds"]:
+                    best[run] = {
+                        "seconds": seconds,
+                        "requests": sum(requests.values()),
+                        "by_verb": requests,
+                        "applied": results.get("objects", {}).get("applied", 0),
+                        "skipped": results.get("objects", {}).get("skipped", 0),
+                        "success": results["success"],
+                    }
+    return best
+
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list:
+    """Wall times and request counts that grew by more than threshold over the baseline."""
+    found = []
+    for name, runs in results.items():
+        for run, metrics in runs.items():
+            previous = baseline.get(name, {}).get(run)
+            if not previous:
+                continue
+            for metric in ("seconds", "requests"):
+                if metric == "seconds" and max(previous[metric], metrics[metric]) < NOISE_FLOOR_SECONDS:
+                    continue
+                if previous[metric] and metrics[metric] > previous[metric] * (1 + threshold):
+                    found.append(
+                        f"{name}.{run}.{metric}: {previous[metric]:.3f} -> {metrics[metric]:.3f} "
+                        f"(+{metrics[metric] / previous[metric] - 1:.0%})"
+                    )
+    return found
+
+
+def report(results: dict) -> None:
+    print(f"{'manifests':>9} {'run':<10} {'seconds':>8} {'requests':>8} {'applied':>7} {'skipped':>7}  by verb")
+    for name, runs in results.items():
+        for run, metrics in runs.items():
+            verbs = ", ".join(f"{verb} {count}" for verb, count in sorted(metrics["by_verb"].items()))
+            status = "" if metrics["success"] else "  FAILED"
+            print(
+                f"{name:>9} {run:<10} {metrics['seconds']:>8.3f} {metrics['requests']:>8} "
+                f"{metrics['applied']:>7} {metrics['skipped']:>7}  {verbs}{status}"
+            )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the bootstrap Lambda against a fake API server")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="manifest count to run (repeatable, default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scenario, best is kept")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every API request")
+    parser.add_argument("--crd-delay", type=float, default=0.0, help="seconds until a new CRD is Established")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API requests failing with 500")
+    parser.add_argument("--baseline", help="compare against this baseline file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed relative regression over the baseline (default: 0.2)")
+    parser.add_argument("--save-baseline", help="write the results to this baseline file")
+    parser.add_argument("--bundle-mb", type=float, default=20,
+                        help="uncompressed size of the bundle whose parse memory is measured (0: skip)")
+    parser.add_argument("--max-bundle-overhead", type=float, default=0.25,
+                        help="allowed parse memory above the parsed result, as a fraction of the "
+                             "uncompressed bundle (default: 0.25)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    server_options = {"latency": args.latency, "crd_delay": args.crd_delay, "error_rate": args.error_rate}
+    results = {name: run_scenario(SCENARIOS[name], args.repeat, server_options) for name in args.scenario or SCENARIOS}
+    report(results)
+
+    found = []
+    if args.bundle_mb:
+        memory = measure_bundle(args.bundle_mb)
+        print(
+            f"\nbundle {memory['bytes'] / 2**20:.1f} MB ({memory['gzip_bytes'] / 2**20:.1f} MB gzip, "
+            f"{memory['documents']} documents) parsed from S3 in {memory['seconds']:.2f}s: "
+            f"peak {memory['peak'] / 2**20:.1f} MB, retained {memory['retained'] / 2**20:.1f} MB, "
+            f"overhead {memory['overhead']:.1%} of the bundle"
+        )
+        if memory["overhead"] > args.max_bundle_overhead:
+            found.append(
+                f"bundle.memory: parse overhead {memory['overhead']:.1%} > {args.max_bundle_overhead:.0%}"
+            )
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        found += regressions(results, baseline, args.threshold)
+    for regression in found:
+        print(f"REGRESSION {regression}")
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
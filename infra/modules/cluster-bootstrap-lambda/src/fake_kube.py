@@ -0,0 +1,494 @@
+"""
+Fake Kubernetes API server for exercising the bootstrap Lambda locally
+
+Implements just enough of the API for handler.py: discovery, GET, LIST, WATCH, POST,
+PUT, PATCH (strategic merge, merge and apply) and DELETE for built-in and custom
+resources. CRDs become Established after a configurable delay. Per-request latency
+and error rates, and failures for given object names, can be injected, and requests
+are counted by verb.
+
+Not part of the Lambda package (build.sh only ships handler.py); used by benchmark.py.
+"""
+
+import base64
+import copy
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import yaml
+
+# (group, version) -> {plural: (kind, namespaced)}
+BUILTIN_RESOURCES = {
+    ("", "v1"): {
+        "namespaces": ("Namespace", False),
+        "configmaps": ("ConfigMap", True),
+        "secrets": ("Secret", True),
+        "serviceaccounts": ("ServiceAccount", True),
+        "services": ("Service", True),
+        "pods": ("Pod", True),
+        "persistentvolumeclaims": ("PersistentVolumeClaim", True),
+    },
+    ("apps", "v1"): {
+        "deployments": ("Deployment", True),
+        "statefulsets": ("StatefulSet", True),
+        "daemonsets": ("DaemonSet", True),
+    },
+    ("rbac.authorization.k8s.io", "v1"): {
+        "roles": ("Role", True),
+        "rolebindings": ("RoleBinding", True),
+        "clusterroles": ("ClusterRole", False),
+        "clusterrolebindings": ("ClusterRoleBinding", False),
+    },
+    ("apiextensions.k8s.io", "v1"): {
+        "customresourcedefinitions": ("CustomResourceDefinition", False),
+    },
+    ("networking.k8s.io", "v1"): {
+        "networkpolicies": ("NetworkPolicy", True),
+        "ingresses": ("Ingress", True),
+    },
+    ("policy", "v1"): {
+        "poddisruptionbudgets": ("PodDisruptionBudget", True),
+    },
+    ("admissionregistration.k8s.io", "v1"): {
+        "validatingwebhookconfigurations": ("ValidatingWebhookConfiguration", False),
+        "mutatingwebhookconfigurations": ("MutatingWebhookConfiguration", False),
+    },
+    ("batch", "v1"): {
+        "jobs": ("Job", True),
+    },
+}
+
+
+def merge(target: dict, patch: dict) -> dict:
+    """JSON merge patch (RFC 7386), also used for strategic merge and apply."""
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+    return target
+
+
+class FakeKubeState:
+    """Objects, served resources and request counters shared by all handler threads."""
+
+    def __init__(self, crd_delay: float = 0.0, latency: float = 0.0, error_rate: float = 0.0,
+                 reject_apply: bool = False, fail_names: tuple = (), fail_lists: tuple = (),
+                 seed: int = 0):
+        self.crd_delay = crd_delay
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reject_apply = reject_apply
+        self.fail_names = set(fail_names)
+        # Names whose LIST by field selector (metadata.name=<name>) answers with a 500
+        self.fail_lists = set(fail_lists)
+        self.random = random.Random(seed)
+        self.lock = threading.Condition()
+        self.resources = copy.deepcopy(BUILTIN_RESOURCES)
+        # (group, version, plural, namespace, name) -> object
+        self.objects: dict = {}
+        self.resource_version = 0
+        self.requests: Counter = Counter()
+        self.timers: list = []
+
+    def count(self, verb: str) -> None:
+        with self.lock:
+            self.requests[verb] += 1
+
+    def next_version(self) -> str:
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def establish_crd(self, name: str) -> None:
+        """Serve the CRD's kind and mark it Established (called after crd_delay)."""
+        with self.lock:
+            crd = self.objects.get(("apiextensions.k8s.io", "v1", "customresourcedefinitions", None, name))
+            if crd is None:
+                return
+            spec = crd["spec"]
+            for version in spec.get("versions", []):
+                served = self.resources.setdefault((spec["group"], version["name"]), {})
+                served[spec["names"]["plural"]] = (spec["names"]["kind"], spec.get("scope") == "Namespaced")
+            crd["status"] = {
+                "conditions": [
+                    {"type": "NamesAccepted", "status": "True"},
+                    {"type": "Established", "status": "True"},
+                ],
+                "acceptedNames": spec["names"],
+            }
+            crd["metadata"]["resourceVersion"] = self.next_version()
+            self.lock.notify_all()
+
+    def on_created(self, group: str, plural: str, obj: dict) -> None:
+        if group == "apiextensions.k8s.io" and plural == "customresourcedefinitions":
+            name = obj["metadata"]["name"]
+            if self.crd_delay > 0:
+                timer = threading.Timer(self.crd_delay, self.establish_crd, args=(name,))
+                timer.daemon = True
+                self.timers.append(timer)
+                timer.start()
+            else:
+                threading.Thread(target=self.establish_crd, args=(name,), daemon=True).start()
+
+
+class FakeKubeHandler(BaseHTTPRequestHandler):
+    """Serves one connection; the state is shared through the class attribute."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    state: FakeKubeState
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_status(self, code: int, reason: str, message: str) -> None:
+        self.send_json(code, {
+            "kind": "Status", "apiVersion": "v1", "status": "Failure",
+            "message": message, "reason": reason, "code": code,
+        })
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if not raw:
+            return None
+        if "yaml" in (self.headers.get("Content-Type") or ""):
+            return yaml.safe_load(raw)
+        return json.loads(raw)
+
+    def route(self):
+        """Split the path into (group, version, namespace, plural, name, subresource)."""
+        parts = [p for p in urlparse(self.path).path.split("/") if p]
+        if parts[:1] == ["api"]:
+            group, rest = "", parts[1:]
+        elif parts[:1] == ["apis"]:
+            group, rest = (parts[1], parts[2:]) if len(parts) > 1 else ("", [])
+        else:
+            return None
+        if not rest:
+            return (group, None, None, None, None, None)
+        version, rest = rest[0], rest[1:]
+        namespace = None
+        # /api/v1/namespaces/<name> is the namespace itself, not a namespaced path
+        if len(rest) > 2 and rest[0] == "namespaces":
+            namespace, rest = rest[1], rest[2:]
+        plural = rest[0] if rest else None
+        name = rest[1] if len(rest) > 1 else None
+        subresource = rest[2] if len(rest) > 2 else None
+        return (group, version, namespace, plural, name, subresource)
+
+    def handle_any(self, verb: str) -> None:
+        state = self.state
+        if state.latency:
+            time.sleep(state.latency)
+        query = parse_qs(urlparse(self.path).query)
+        is_watch = query.get("watch", ["false"])[0] == "true"
+        state.count("watch" if is_watch else verb)
+        if state.error_rate and state.random.random() < state.error_rate:
+            # Read the body anyway, or it is parsed as the connection's next request
+            self.read_body()
+            self.send_status(500, "InternalError", "injected failure")
+            return
+
+        path = urlparse(self.path).path
+        if path == "/version":
+            self.send_json(200, {"major": "1", "minor": "31", "gitVersion": "v1.31.0"})
+            return
+        if path == "/api":
+            self.send_json(200, {"kind": "APIVersions", "versions": ["v1"]})
+            return
+        if path == "/apis":
+            self.send_json(200, self.group_list())
+            return
+
+        route = self.route()
+        if route is None:
+            self.send_status(404, "NotFound", f"{path} not found")
+            return
+        group, version, namespace, plural, name, subresource = route
+        if version is None:
+            self.send_status(404, "NotFound", f"{path} not found")
+            return
+        with state.lock:
+            served = state.resources.get((group, version))
+        if served is None:
+            self.send_status(404, "NotFound", f"the server could not find the requested resource ({group}/{version})")
+            return
+        if plural is None:
+            self.send_json(200, self.resource_list(group, version, served))
+            return
+        if plural not in served:
+            self.send_status(404, "NotFound", f"the server could not find the requested resource ({plural})")
+            return
+        kind, namespaced = served[plural]
+        key_ns = namespace if namespaced else None
+
+        if verb == "get" and name is None:
+            if is_watch:
+                self.watch(group, version, plural, key_ns, query)
+            else:
+                self.list(group, version, plural, kind, key_ns, query)
+        elif verb == "get":
+            self.get(group, version, plural, key_ns, name)
+        elif verb == "post":
+            self.create(group, version, plural, kind, key_ns, self.read_body(), query)
+        elif verb == "put":
+            self.replace(group, version, plural, key_ns, name, self.read_body())
+        elif verb == "patch":
+            self.patch(group, version, plural, kind, key_ns, name, self.read_body(), query)
+        elif verb == "delete":
+            self.delete(group, version, plural, key_ns, name)
+        else:
+            self.send_status(405, "MethodNotAllowed", verb)
+
+    def do_GET(self):
+        self.handle_any("get")
+
+    def do_POST(self):
+        self.handle_any("post")
+
+    def do_PUT(self):
+        self.handle_any("put")
+
+    def do_PATCH(self):
+        self.handle_any("patch")
+
+    def do_DELETE(self):
+        self.handle_any("delete")
+
+    def group_list(self) -> dict:
+        with self.state.lock:
+            groups: dict = {}
+            for group, version in self.state.resources:
+                if group:
+                    groups.setdefault(group, []).append(version)
+        return {
+            "kind": "APIGroupList",
+            "apiVersion": "v1",
+            "groups": [
+                {
+                    "name": group,
+                    "versions": [{"groupVersion": f"{group}/{v}", "version": v} for v in versions],
+                    "preferredVersion": {"groupVersion": f"{group}/{versions[0]}", "version": versions[0]},
+                }
+                for group, versions in groups.items()
+            ],
+        }
+
+    def resource_list(self, group: str, version: str, served: dict) -> dict:
+        return {
+            "kind": "APIResourceList",
+            "apiVersion": "v1",
+            "groupVersion": f"{group}/{version}" if group else version,
+            "resources": [
+                {
+                    "name": plural,
+                    "singularName": kind.lower(),
+                    "namespaced": namespaced,
+                    "kind": kind,
+                    "verbs": ["create", "delete", "get", "list", "patch", "update", "watch"],
+                }
+                for plural, (kind, namespaced) in served.items()
+            ],
+        }
+
+    def get(self, group, version, plural, namespace, name):
+        with self.state.lock:
+            obj = self.state.objects.get((group, version, plural, namespace, name))
+        if obj is None:
+            self.send_status(404, "NotFound", f'{plural} "{name}" not found')
+        else:
+            self.send_json(200, obj)
+
+    def list(self, group, version, plural, kind, namespace, query):
+        selector = query.get("fieldSelector", [""])[0]
+        if selector.partition("=")[2] in self.state.fail_lists:
+            self.send_status(500, "InternalError", "injected failure")
+            return
+        with self.state.lock:
+            items = [
+                obj for (g, v, p, ns, n), obj in self.state.objects.items()
+                if (g, v, p) == (group, version, plural) and (namespace is None or ns == namespace)
+                and (not selector or selector == f"metadata.name={n}")
+            ]
+            rv = str(self.state.resource_version)
+        self.send_json(200, {
+            "kind": f"{kind}List",
+            "apiVersion": f"{group}/{version}" if group else version,
+            "metadata": {"resourceVersion": rv},
+            "items": items,
+        })
+
+    def watch(self, group, version, plural, namespace, query):
+        """Stream ADDED/MODIFIED events until timeoutSeconds elapses."""
+        timeout = float(query.get("timeoutSeconds", ["30"])[0])
+        selector = query.get("fieldSelector", [""])[0]
+        deadline = time.monotonic() + timeout
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        seen: dict = {}
+        try:
+            while True:
+                with self.state.lock:
+                    matches = [
+                        obj for (g, v, p, ns, n), obj in self.state.objects.items()
+                        if (g, v, p) == (group, version, plural) and (namespace is None or ns == namespace)
+                        and (not selector or selector == f"metadata.name={n}")
+                    ]
+                for obj in matches:
+                    uid = obj["metadata"]["uid"]
+                    rv = obj["metadata"]["resourceVersion"]
+                    if seen.get(uid) != rv:
+                        event = {"type": "MODIFIED" if uid in seen else "ADDED", "object": obj}
+                        seen[uid] = rv
+                        line = json.dumps(event).encode() + b"\n"
+                        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                        self.wfile.flush()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                with self.state.lock:
+                    self.state.lock.wait(min(remaining, 0.05))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def new_object(self, group, version, plural, kind, namespace, body) -> dict:
+        obj = copy.deepcopy(body)
+        obj.setdefault("apiVersion", f"{group}/{version}" if group else version)
+        obj.setdefault("kind", kind)
+        meta = obj.setdefault("metadata", {})
+        if namespace:
+            meta["namespace"] = namespace
+        meta["uid"] = str(uuid.uuid4())
+        meta["resourceVersion"] = self.state.next_version()
+        meta["creationTimestamp"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        if kind == "Secret" and "stringData" in obj:
+            data = obj.setdefault("data", {})
+            for k, v in obj.pop("stringData").items():
+                data[k] = base64.b64encode(str(v).encode()).decode()
+        return obj
+
+    def create(self, group, version, plural, kind, namespace, body, query):
+        name = body["metadata"]["name"]
+        key = (group, version, plural, namespace, name)
+        dry_run = "dryRun" in query
+        with self.state.lock:
+            if key in self.state.objects:
+                self.send_status(409, "AlreadyExists", f'{plural} "{name}" already exists')
+                return
+            obj = self.new_object(group, version, plural, kind, namespace, body)
+            if not dry_run:
+                self.state.objects[key] = obj
+                self.state.lock.notify_all()
+        if not dry_run:
+            self.state.on_created(group, plural, obj)
+        self.send_json(201, obj)
+
+    def replace(self, group, version, plural, namespace, name, body):
+        key = (group, version, plural, namespace, name)
+        with self.state.lock:
+            current = self.state.objects.get(key)
+            if current is None:
+                self.send_status(404, "NotFound", f'{plural} "{name}" not found')
+                return
+            obj = copy.deepcopy(body)
+            obj["metadata"].update({k: current["metadata"][k] for k in ("uid", "creationTimestamp")})
+            obj["metadata"]["resourceVersion"] = self.state.next_version()
+            self.state.objects[key] = obj
+            self.state.lock.notify_all()
+        self.send_json(200, obj)
+
+    def patch(self, group, version, plural, kind, namespace, name, body, query):
+        content_type = (self.headers.get("Content-Type") or "").split(";")[0]
+        key = (group, version, plural, namespace, name)
+        if name in self.state.fail_names:
+            self.send_status(422, "Invalid", f'{plural} "{name}" is invalid')
+            return
+        dry_run = "dryRun" in query
+        is_apply = content_type == "application/apply-patch+yaml"
+        if is_apply and self.state.reject_apply:
+            self.send_status(415, "UnsupportedMediaType", f"{content_type} is not supported")
+            return
+        if content_type == "application/strategic-merge-patch+json" and group not in {g for g, _ in BUILTIN_RESOURCES}:
+            self.send_status(415, "UnsupportedMediaType", "strategic merge patch is not supported for custom resources")
+            return
+        if is_apply and "fieldManager" not in query:
+            self.send_status(400, "BadRequest", "fieldManager is required for apply patch")
+            return
+
+        created = False
+        with self.state.lock:
+            current = self.state.objects.get(key)
+            if current is None:
+                if not is_apply:
+                    self.send_status(404, "NotFound", f'{plural} "{name}" not found')
+                    return
+                obj = self.new_object(group, version, plural, kind, namespace, body)
+                created = True
+            else:
+                obj = merge(copy.deepcopy(current), body)
+                if obj != current:
+                    obj["metadata"]["resourceVersion"] = self.state.next_version()
+            if not dry_run:
+                self.state.objects[key] = obj
+                self.state.lock.notify_all()
+        if created and not dry_run:
+            self.state.on_created(group, plural, obj)
+        self.send_json(201 if created else 200, obj)
+
+    def delete(self, group, version, plural, namespace, name):
+        with self.state.lock:
+            obj = self.state.objects.pop((group, version, plural, namespace, name), None)
+            self.state.lock.notify_all()
+        if obj is None:
+            self.send_status(404, "NotFound", f'{plural} "{name}" not found')
+        else:
+            self.send_json(200, obj)
+
+
+class FakeKubeServer:
+    """Runs a FakeKubeHandler server on an ephemeral localhost port in a thread."""
+
+    def __init__(self, **options):
+        self.state = FakeKubeState(**options)
+        handler = type("Handler", (FakeKubeHandler,), {"state": self.state})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakeKubeServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for timer in self.state.timers:
+            timer.cancel()
@@ -7,26 +7,218 @@ via IAM (EKS Access Entries).
 """
 
 import base64
+import contextlib
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
 import json
 import logging
 import os
 import tempfile
+import threading
 import time
-from typing import Any, Optional
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, Optional
+from urllib.parse import urlparse
+
+# Module import time is reported with the first (cold) invocation
+_IMPORT_STARTED = time.perf_counter()
 
 import boto3
 import yaml
+from botocore.exceptions import ClientError
 
 # Import kubernetes client
-from kubernetes import client as k8s_client
-from kubernetes import dynamic
+from kubernetes import dynamic, watch
 from kubernetes.client import Configuration, ApiClient
 from kubernetes.client.rest import ApiException
-from kubernetes.dynamic.exceptions import NotFoundError
+from kubernetes.dynamic.exceptions import NotFoundError, ResourceNotFoundError
+from urllib3.exceptions import HTTPError
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# libyaml's loader when PyYAML was built with it (same safe semantics, several times faster)
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Concurrent API requests while applying manifests
+APPLY_WORKERS = int(os.environ.get("APPLY_WORKERS", "8"))
+# Concurrent Secrets Manager requests, and the BatchGetSecretValue SecretIdList limit
+SECRETS_WORKERS = int(os.environ.get("SECRETS_WORKERS", "8"))
+SECRETS_BATCH_SIZE = 20
+# CloudWatch Embedded Metric Format output, and how many of the slowest objects it lists
+METRICS_ENABLED = os.environ.get("BOOTSTRAP_METRICS", "true").lower() != "false"
+METRICS_SLOWEST = int(os.environ.get("BOOTSTRAP_METRICS_SLOWEST", "10"))
+# Clusters bootstrapped concurrently when an event lists several
+CLUSTER_WORKERS = int(os.environ.get("CLUSTER_WORKERS", "4"))
+# Seconds between CRD readiness checks after a failed LIST or WATCH
+CRD_RETRY_DELAY = 1.0
+# Seconds before the Lambda timeout at which a bootstrap stops and checkpoints
+TIMEOUT_MARGIN = float(os.environ.get("TIMEOUT_MARGIN", "30"))
+# Seconds a warm execution environment reuses describe_cluster results
+CLUSTER_INFO_TTL = int(os.environ.get("CLUSTER_INFO_TTL", "300"))
+# HMAC key for the desired-state hashes of Secrets. Without one, a random key per execution
+# environment is used, and Secrets are applied again after every cold start.
+SECRET_HASH_KEY = os.environ.get("BOOTSTRAP_HASH_KEY", "").encode() or os.urandom(32)
+
+# Reused across warm invocations of the same execution environment
+_aws_clients: dict = {}
+_cluster_info: dict = {}
+_eks_auth: dict = {}
+_cache_lock = threading.Lock()
+_cold_start = True
+
+
+def aws_client(service: str, region: Optional[str] = None) -> Any:
+    """Return a boto3 client, created once per execution environment."""
+    with _cache_lock:
+        if (service, region) not in _aws_clients:
+            _aws_clients[(service, region)] = boto3.client(service, region_name=region)
+        return _aws_clients[(service, region)]
+
+
+class BootstrapMetrics:
+    """
+    Timings and counters for one invocation.
+
+    They are emitted as CloudWatch Embedded Metric Format (EMF) log lines, which
+    CloudWatch turns into metrics without any API calls, and summarized in the results.
+    When disabled, every method returns immediately.
+    """
+
+    NAMESPACE = "ClusterBootstrap"
+
+    def __init__(self, cluster_name: str, enabled: bool = METRICS_ENABLED, slowest: int = METRICS_SLOWEST):
+        self.cluster_name = cluster_name
+        self.enabled = enabled
+        self.slowest_count = slowest
+        self.steps: dict = {}
+        self.api_calls: Counter = Counter()
+        self.api_seconds = 0.0
+        self.retries: Counter = Counter()
+        # Min-heap of (seconds, object, outcome), the slowest objects so far
+        self._slowest: list = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        """Time a bootstrap step."""
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = round(time.perf_counter() - started, 3)
+
+    def instrument(self, api_client: ApiClient) -> None:
+        """Count and time the Kubernetes API requests made through api_client, by verb."""
+        if not self.enabled:
+            return
+        rest = api_client.rest_client
+        request = rest.request
+
+        def counted(method, url, *args, **kwargs):
+            # Older clients pass the query separately, newer ones in the url
+            query = kwargs.get("query_params") or []
+            if "watch=" in url or any(key == "watch" for key, _ in query):
+                verb = "WATCH"
+            elif (kwargs.get("headers") or {}).get("Content-Type") == "application/apply-patch+yaml":
+                verb = "APPLY"
+            else:
+                verb = method.upper()
+            started = time.perf_counter()
+            try:
+                return request(method, url, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self.api_calls[verb] += 1
+                    self.api_seconds += time.perf_counter() - started
+
+        rest.request = counted
+
+    def retry(self, reason: str, count: int = 1) -> None:
+        """Count requests repeated another way, e.g. after a batch or apply was rejected."""
+        if not self.enabled or not count:
+            return
+        with self._lock:
+            self.retries[reason] += count
+
+    def observe(self, obj: str, seconds: float, outcome: str) -> None:
+        """Record how long one object took, keeping the slowest ones."""
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = (seconds, obj, outcome)
+            if len(self._slowest) < self.slowest_count:
+                heapq.heappush(self._slowest, entry)
+            elif entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self) -> list:
+        """The slowest objects, slowest first."""
+        return [
+            {"object": obj, "seconds": round(seconds, 3), "outcome": outcome}
+            for seconds, obj, outcome in sorted(self._slowest, reverse=True)
+        ]
+
+    def summary(self) -> dict:
+        return {
+            "steps": self.steps,
+            "api_calls": dict(self.api_calls),
+            "api_seconds": round(self.api_seconds, 3),
+            "retries": dict(self.retries),
+            "slowest": self.slowest(),
+        }
+
+    def emit(self, values: dict) -> None:
+        """
+        Write the metrics as EMF log lines: one with the invocation totals in values,
+        one per step and one per API verb.
+
+        Args:
+            values: Metric name -> (value, unit) for the invocation totals
+        """
+        if not self.enabled:
+            return
+        values = {
+            **values,
+            "ApiCalls": (sum(self.api_calls.values()), "Count"),
+            "ApiSeconds": (round(self.api_seconds, 3), "Seconds"),
+            "Retries": (sum(self.retries.values()), "Count"),
+        }
+        self._write(["Cluster"], values, {
+            "Steps": self.steps,
+            "RetryReasons": dict(self.retries),
+            "SlowestObjects": self.slowest(),
+        })
+        for step, seconds in self.steps.items():
+            self._write(["Cluster", "Step"], {"StepSeconds": (seconds, "Seconds")}, {"Step": step})
+        for verb, count in self.api_calls.items():
+            self._write(["Cluster", "Verb"], {"ApiCalls": (count, "Count")}, {"Verb": verb})
+
+    def _write(self, dimensions: list, values: dict, properties: dict) -> None:
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.NAMESPACE,
+                    "Dimensions": [dimensions],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in values.items()],
+                }],
+            },
+            "Cluster": self.cluster_name,
+            **properties,
+            **{name: value for name, (value, _) in values.items()},
+        }
+        # EMF records must be bare JSON lines, without the logger's prefix
+        print(json.dumps(record), flush=True)
+
 
 class EKSAuth:
     """Handles EKS authentication using IAM."""
@@ -39,12 +231,27 @@ class EKSAuth:
         self.cluster_name = cluster_name
         self.region = region
         self.session = boto3.Session()
+        self._sts = None
+        self._token = None
+        self._token_expires = 0.0
+        self._lock = threading.Lock()
 
     def get_token(self) -> str:
+        """Return the current token, generating a new one when it is about to expire."""
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._token_expires:
+                self._token = self._generate_token()
+                # Tokens are valid for 15 minutes; refresh a minute early
+                self._token_expires = time.monotonic() + self.TOKEN_EXPIRATION_MINS * 60
+            return self._token
+
+    def _generate_token(self) -> str:
         """Generate EKS token using standard boto3 approach."""
         from botocore.signers import RequestSigner
 
-        client = self.session.client("sts", region_name=self.region)
+        if self._sts is None:
+            self._sts = self.session.client("sts", region_name=self.region)
+        client = self._sts
         signer = RequestSigner(
             client.meta.service_model.service_id,
             self.region,
@@ -69,41 +276,84 @@ class EKSAuth:
         return self.TOKEN_PREFIX + base64.urlsafe_b64encode(url.encode()).decode().rstrip("=")
 
 
+def get_eks_auth(cluster_name: str, region: str) -> EKSAuth:
+    """Return the EKSAuth (and so its cached token) for a cluster."""
+    with _cache_lock:
+        if (cluster_name, region) not in _eks_auth:
+            _eks_auth[(cluster_name, region)] = EKSAuth(cluster_name, region)
+        return _eks_auth[(cluster_name, region)]
+
+
 def get_cluster_info(cluster_name: str, region: str) -> dict:
-    """Get EKS cluster endpoint and CA data."""
-    eks = boto3.client("eks", region_name=region)
+    """Get EKS cluster endpoint and CA data (cached for CLUSTER_INFO_TTL seconds)."""
+    cached = _cluster_info.get((cluster_name, region))
+    if cached and time.monotonic() - cached[0] < CLUSTER_INFO_TTL:
+        return cached[1]
+
+    eks = aws_client("eks", region)
     cluster = eks.describe_cluster(name=cluster_name)["cluster"]
-    return {
+    info = {
         "endpoint": cluster["endpoint"],
         "ca_data": cluster["certificateAuthority"]["data"],
     }
+    _cluster_info[(cluster_name, region)] = (time.monotonic(), info)
+    return info
+
+
+def forget_cluster(cluster_name: str, region: str) -> None:
+    """Drop cached cluster info, e.g. after a failure that may come from a replaced cluster."""
+    _cluster_info.pop((cluster_name, region), None)
 
 
 def get_secrets_from_sm(
-    secret_arns: list, region: str
+    secret_arns: list, region: str, metrics: Optional[BootstrapMetrics] = None
 ) -> dict:
     """
     Read secrets from Secrets Manager by explicit ARNs.
 
+    Secrets are fetched with BatchGetSecretValue in chunks of SECRETS_BATCH_SIZE,
+    concurrently. Secrets a batch could not return are fetched one by one.
+
     Args:
         secret_arns: List of dicts with 'arn' and optional 'name' keys
         region: AWS region
+        metrics: Counts the secrets fetched one by one as retries
 
     Returns a dict: {"secret-name": {"key": "value", ...}, ...}
     """
-    sm = boto3.client("secretsmanager", region_name=region)
+    sm = aws_client("secretsmanager", region)
     secrets = {}
 
     if not secret_arns:
         return secrets
 
+    arns = list(dict.fromkeys(secret_info.get("arn") for secret_info in secret_arns))
+    chunks = [arns[i:i + SECRETS_BATCH_SIZE] for i in range(0, len(arns), SECRETS_BATCH_SIZE)]
+    values = {}
+
+    with ThreadPoolExecutor(max_workers=min(SECRETS_WORKERS, len(arns))) as pool:
+        missing = []
+        for found, errors in pool.map(lambda chunk: batch_get_secret_values(sm, chunk), chunks):
+            values.update(found)
+            missing.extend(errors)
+
+        def get_secret_value(secret_arn: str) -> str:
+            try:
+                return sm.get_secret_value(SecretId=secret_arn)["SecretString"]
+            except Exception as e:
+                logger.error(f"Failed to read secret {secret_arn}: {e}")
+                raise  # Fail fast - explicit secrets must exist
+
+        if metrics:
+            metrics.retry("secret_fetch", len(missing))
+        values.update(zip(missing, pool.map(get_secret_value, missing)))
+
     for secret_info in secret_arns:
         secret_arn = secret_info.get("arn")
         short_name = secret_info.get("name", secret_arn.split("/")[-1])
 
         try:
-            value = sm.get_secret_value(SecretId=secret_arn)
-            secret_data = json.loads(value["SecretString"])
+            secret_data = json.loads(values[secret_arn])
             secrets[short_name] = secret_data
             logger.info(f"Loaded secret: {short_name}")
         except Exception as e:
@@ -113,116 +363,480 @@ def get_secrets_from_sm(
     return secrets
 
 
-def create_k8s_client(endpoint: str, ca_data: str, token: str) -> ApiClient:
-    """Create a configured Kubernetes API client."""
-    # Write CA cert to temp file
-    ca_cert_file = tempfile.NamedTemporaryFile(delete=False, suffix=".crt")
-    ca_cert_file.write(base64.b64decode(ca_data))
-    ca_cert_file.close()
+def batch_get_secret_values(sm: Any, secret_arns: list) -> tuple:
+    """
+    Fetch up to SECRETS_BATCH_SIZE secrets with one BatchGetSecretValue call.
 
+    Returns:
+        ({arn: SecretString}, [arns the batch did not return])
+    """
+    try:
+        response = sm.batch_get_secret_value(SecretIdList=secret_arns)
+    except ClientError as e:
+        # E.g. no secretsmanager:BatchGetSecretValue permission
+        logger.warning(f"BatchGetSecretValue failed, reading {len(secret_arns)} secrets one by one: {e}")
+        return {}, list(secret_arns)
+
+    # Secrets can be requested by full ARN, partial ARN (no random suffix) or name
+    returned = {}
+    for value in response.get("SecretValues", []):
+        returned[value["ARN"]] = value["SecretString"]
+        returned[value["Name"]] = value["SecretString"]
+        returned[value["ARN"].rsplit("-", 1)[0]] = value["SecretString"]
+
+    for error in response.get("Errors", []):
+        logger.warning(f"BatchGetSecretValue could not read {error.get('SecretId')}: {error.get('ErrorCode')}")
+
+    found = {arn: returned[arn] for arn in secret_arns if arn in returned}
+    return found, [arn for arn in secret_arns if arn not in returned]
+
+
+def ca_cert_file(ca_data: str) -> str:
+    """Write a cluster CA to a file named by its content, once per execution environment."""
+    digest = hashlib.sha256(ca_data.encode()).hexdigest()[:16]
+    path = os.path.join(tempfile.gettempdir(), f"eks-ca-{digest}.crt")
+    if not os.path.exists(path):
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as file:
+            file.write(base64.b64decode(ca_data))
+        os.replace(file.name, path)
+    return path
+
+
+def create_k8s_client(endpoint: str, ca_data: str, auth: EKSAuth) -> ApiClient:
+    """Create a configured Kubernetes API client."""
     # Configure client
     config = Configuration()
     config.host = endpoint
-    config.ssl_ca_cert = ca_cert_file.name
-    config.api_key = {"authorization": f"Bearer {token}"}
+    config.ssl_ca_cert = ca_cert_file(ca_data)
+    config.api_key = {"authorization": f"Bearer {auth.get_token()}"}
+    # Checked before every request, so a reused token is replaced before it expires
+    config.refresh_api_key_hook = lambda c: c.api_key.update(
+        authorization=f"Bearer {auth.get_token()}"
+    )
+    # One connection per apply worker
+    config.connection_pool_maxsize = max(config.connection_pool_maxsize, APPLY_WORKERS)
 
     return ApiClient(configuration=config)
 
 
-def create_namespace(api_client: ApiClient, name: str) -> bool:
+class ResourceCache:
+    """
+    Resolves (apiVersion, kind) to dynamic client resources for a whole invocation.
+
+    Discovery is done per group/version: the first lookup in a group/version fetches
+    its resource list once, and a miss refetches only that group/version instead of
+    invalidating the whole discovery tree.
+    """
+
+    def __init__(self, api_client: ApiClient):
+        self.client = dynamic.DynamicClient(api_client)
+        self._group_versions: dict = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "discoveries": 0, "invalidations": 0}
+
+    def _discover(self, api_version: str) -> dict:
+        group, _, version = api_version.rpartition("/")
+        prefix = "apis" if group else "api"
+        self.stats["discoveries"] += 1
+        try:
+            resources = self.client.resources.get_resources_for_api_version(
+                prefix, group, version, True
+            )
+        except NotFoundError:
+            # Group/version not served (yet), e.g. its CRD was just created
+            resources = {}
+        self._group_versions[api_version] = resources
+        return resources
+
+    def get(self, api_version: str, kind: str):
+        """Return the resource for apiVersion/kind, raising ResourceNotFoundError if not served."""
+        with self._lock:
+            resources = self._group_versions.get(api_version)
+            if resources is not None and resources.get(kind):
+                self.stats["hits"] += 1
+            else:
+                self.stats["misses"] += 1
+                resources = self._discover(api_version)
+                if not resources.get(kind):
+                    raise ResourceNotFoundError(f"No matches found for {kind} ({api_version})")
+            return resources[kind][0]
+
+    def invalidate(self, api_version: str) -> None:
+        """Forget discovery for a single group/version."""
+        with self._lock:
+            if self._group_versions.pop(api_version, None) is not None:
+                self.stats["invalidations"] += 1
+
+
+class ManifestApplier:
+    """
+    Applies manifests with a single server-side apply PATCH per object.
+
+    If the API server rejects apply patches, the rest of the invocation falls back to
+    get -> patch -> create. With dry_run nothing is persisted; every object is compared
+    against the live one and the outcome recorded in `plan`.
+
+    Every applied object is stamped with a hash of its desired state. Live hashes are
+    read with one LIST per (kind, namespace), and objects whose hash matches are skipped.
+    """
+
+    FIELD_MANAGER = "cluster-bootstrap"
+    HASH_ANNOTATION = "qts.one/bootstrap-hash"
+    # Set by the API server, ignored when comparing live and planned objects
+    SERVER_METADATA = ("uid", "resourceVersion", "generation", "creationTimestamp", "managedFields")
+
+    def __init__(
+        self,
+        resources: ResourceCache,
+        server_side: bool = True,
+        dry_run: bool = False,
+        force_conflicts: bool = True,
+        skip_unchanged: bool = True,
+        metrics: Optional[BootstrapMetrics] = None,
+    ):
+        self.resources = resources
+        self.server_side = server_side
+        self.dry_run = dry_run
+        self.force_conflicts = force_conflicts
+        self.skip_unchanged = skip_unchanged
+        self.metrics = metrics
+        self.plan: list = []
+        self.stats = {"applied": 0, "skipped": 0}
+        # (apiVersion, kind, namespace) -> {name: live hash}
+        self._live_hashes: dict = {}
+        self._list_locks: dict = {}
+        self._lock = threading.Lock()
+
+    def apply(self, api, manifest: dict) -> str:
+        """
+        Apply a manifest to its resource.
+
+        Returns:
+            "applied", "created", "updated" or "unchanged" (skipped); with dry_run,
+            the planned "create", "update" or "unchanged"
+        """
+        metadata = manifest.get("metadata", {})
+        name = metadata.get("name")
+        namespace = metadata.get("namespace")
+        dry_run = "All" if self.dry_run else None
+
+        digest = desired_hash(manifest)
+        if self.skip_unchanged and self._live_hash(api, namespace, name) == digest:
+            self._count("skipped")
+            if self.dry_run:
+                self.record(manifest, "unchanged")
+            return "unchanged"
+        manifest = {
+            **manifest,
+            "metadata": {
+                **metadata,
+                "annotations": {**(metadata.get("annotations") or {}), self.HASH_ANNOTATION: digest},
+            },
+        }
+
+        live = self._get(api, name, namespace) if self.dry_run else None
+        result = None
+        if self.server_side:
+            try:
+                result = api.server_side_apply(
+                    body=manifest,
+                    name=name,
+                    namespace=namespace,
+                    field_manager=self.FIELD_MANAGER,
+                    force_conflicts=self.force_conflicts,
+                    dry_run=dry_run,
+                )
+                action = "applied"
+            except ApiException as e:
+                if e.status != 415:
+                    raise
+                logger.warning("API server rejected server-side apply, falling back to patch/create")
+                self.server_side = False
+                if self.metrics:
+                    self.metrics.retry("client_side_apply")
+        if result is None:
+            action, result = self._patch_or_create(api, manifest, name, namespace, dry_run)
+
+        self._count("applied")
+        if self.dry_run:
+            action = self._planned(live, result.to_dict())
+            self.record(manifest, action)
+        return action
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def _live_hash(self, api, namespace: Optional[str], name: str) -> Optional[str]:
+        """Return the hash annotation of the live object, listing its kind/namespace once."""
+        key = (api.group_version, api.kind, namespace)
+        with self._lock:
+            list_lock = self._list_locks.setdefault(key, threading.Lock())
+        with list_lock:
+            if key not in self._live_hashes:
+                try:
+                    items = api.get(namespace=namespace).to_dict().get("items", [])
+                except ApiException as e:
+                    logger.warning(f"Cannot list {api.kind} in {namespace or 'cluster'}, applying all: {e}")
+                    items = []
+                self._live_hashes[key] = {
+                    item["metadata"]["name"]: (item["metadata"].get("annotations") or {}).get(self.HASH_ANNOTATION)
+                    for item in items
+                }
+        return self._live_hashes[key].get(name)
+
+    def record(self, manifest: dict, action: str) -> None:
+        """Add a planned action for a manifest to the plan."""
+        metadata = manifest.get("metadata", {})
+        self.plan.append({
+            "kind": manifest.get("kind"),
+            "name": metadata.get("name"),
+            "namespace": metadata.get("namespace"),
+            "action": action,
+        })
+
+    def _get(self, api, name: str, namespace: Optional[str]) -> Optional[dict]:
+        try:
+            return api.get(name=name, namespace=namespace).to_dict()
+        except NotFoundError:
+            return None
+
+    def _patch_or_create(self, api, manifest: dict, name: str, namespace: Optional[str], dry_run: Optional[str]):
+        """Client-side apply for servers without server-side apply support."""
+        try:
+            api.get(name=name, namespace=namespace)
+        except NotFoundError:
+            return "created", api.create(body=manifest, namespace=namespace, dry_run=dry_run)
+        try:
+            # Try default patch (Strategic Merge Patch for native resources)
+            result = api.patch(body=manifest, name=name, namespace=namespace, dry_run=dry_run)
+        except ApiException as e:
+            if e.status != 415:
+                raise
+            if self.metrics:
+                self.metrics.retry("merge_patch")
+            # Fallback to Merge Patch for Custom Resources
+            result = api.patch(
+                body=manifest,
+                name=name,
+                namespace=namespace,
+                content_type="application/merge-patch+json",
+                dry_run=dry_run,
+            )
+        return "updated", result
+
+    def _planned(self, live: Optional[dict], planned: dict) -> str:
+        if live is None:
+            return "create"
+        return "unchanged" if self._comparable(live) == self._comparable(planned) else "update"
+
+    def _comparable(self, obj: dict) -> dict:
+        obj = dict(obj)
+        obj.pop("status", None)
+        obj["metadata"] = {
+            k: v for k, v in obj.get("metadata", {}).items() if k not in self.SERVER_METADATA
+        }
+        return obj
+
+
+class Checkpoint:
+    """
+    Progress of a bootstrap, kept in a ConfigMap so a re-invocation can resume it.
+
+    The ConfigMap holds the digest of the manifest bundle and the indices of the objects
+    applied so far. A re-invocation with the same bundle skips those objects; any other
+    bundle starts over. Failing to read or write it never fails the bootstrap.
+    """
+
+    NAME = "cluster-bootstrap-progress"
+    NAMESPACE = "argocd"
+
+    def __init__(self, applier: ManifestApplier, digest: str):
+        self.applier = applier
+        self.digest = digest
+        self._saved: Optional[frozenset] = None
+
+    def _api(self):
+        return self.applier.resources.get("v1", "ConfigMap")
+
+    def load(self) -> set:
+        """Indices of the objects already applied from this bundle."""
+        try:
+            data = self._api().get(name=self.NAME, namespace=self.NAMESPACE).to_dict().get("data") or {}
+        except NotFoundError:
+            return set()
+        except ApiException as e:
+            logger.warning(f"Could not read bootstrap checkpoint: {e}")
+            return set()
+        if data.get("digest") != self.digest:
+            logger.info("Bootstrap checkpoint is for another bundle, starting over")
+            return set()
+        try:
+            applied = {int(i) for i in json.loads(zlib.decompress(base64.b64decode(data["applied"])))}
+        except (KeyError, TypeError, ValueError, zlib.error) as e:
+            # Truncated or edited by hand: start over, and let save() or clear() replace it
+            logger.warning(f"Bootstrap checkpoint is unreadable, starting over: {e}")
+            self._saved = frozenset()
+            return set()
+        self._saved = frozenset(applied)
+        logger.info(f"Resuming bootstrap: {len(applied)} objects already applied")
+        return applied
+
+    def save(self, applied: set) -> None:
+        """Record the applied objects, if they changed since the last save."""
+        if self._saved == applied:
+            return
+        encoded = zlib.compress(json.dumps(sorted(applied)).encode())
+        body = {
+            "apiVersion": "v1",
+            "kind": "ConfigMap",
+            "metadata": {"name": self.NAME, "namespace": self.NAMESPACE},
+            "data": {
+                "digest": self.digest,
+                "applied": base64.b64encode(encoded).decode(),
+                "count": str(len(applied)),
+            },
+        }
+        api = self._api()
+        try:
+            if self.applier.server_side:
+                api.server_side_apply(
+                    body=body,
+                    name=self.NAME,
+                    namespace=self.NAMESPACE,
+                    field_manager=self.applier.FIELD_MANAGER,
+                    force_conflicts=True,
+                )
+            else:
+                try:
+                    api.patch(
+                        body=body,
+                        name=self.NAME,
+                        namespace=self.NAMESPACE,
+                        content_type="application/merge-patch+json",
+                    )
+                except NotFoundError:
+                    api.create(body=body, namespace=self.NAMESPACE)
+            self._saved = frozenset(applied)
+        except ApiException as e:
+            logger.warning(f"Could not save bootstrap checkpoint: {e}")
+
+    def clear(self) -> None:
+        """Forget the progress once the bundle is fully applied."""
+        if self._saved is None:
+            return
+        try:
+            self._api().delete(name=self.NAME, namespace=self.NAMESPACE)
+        except NotFoundError:
+            pass
+        except ApiException as e:
+            logger.warning(f"Could not delete bootstrap checkpoint: {e}")
+        self._saved = None
+
+
+def desired_hash(manifest: dict) -> str:
+    """Hash a manifest's desired state (canonical JSON, so key order does not matter)."""
+    content = json.dumps(manifest, sort_keys=True, separators=(",", ":"), default=str)
+    if manifest.get("kind") == "Secret":
+        # The hash is readable wherever Secret data is masked (UI diffs, audit logs); keyed,
+        # it cannot be used to guess the values offline
+        return hmac.new(SECRET_HASH_KEY, content.encode(), hashlib.sha256).hexdigest()
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def create_namespace(applier: ManifestApplier, name: str) -> bool:
     """Create a namespace if it doesn't exist."""
-    v1 = k8s_client.CoreV1Api(api_client)
+    manifest = {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": name}}
 
     try:
-        v1.read_namespace(name=name)
-        logger.info(f"Namespace {name} already exists")
+        action = applier.apply(applier.resources.get("v1", "Namespace"), manifest)
+        logger.info(f"Namespace {name}: {action}")
         return True
     except ApiException as e:
-        if e.status == 404:
-            body = k8s_client.V1Namespace(metadata=k8s_client.V1ObjectMeta(name=name))
-            try:
-                v1.create_namespace(body=body)
-                logger.info(f"Created namespace {name}")
-                return True
-            except ApiException as e:
-                logger.error(f"Failed to create namespace {name}: {e}")
-                return False
-        else:
-            logger.error(f"Error checking namespace {name}: {e}")
-            return False
+        logger.error(f"Failed to create namespace {name}: {e}")
+        return False
 
 
 def create_secret(
-    api_client: ApiClient,
+    applier: ManifestApplier,
     name: str,
     namespace: str,
     data: dict,
     labels: Optional[dict] = None,
 ) -> bool:
     """Create or update a Kubernetes secret."""
-    v1 = k8s_client.CoreV1Api(api_client)
-
-    body = k8s_client.V1Secret(
-        metadata=k8s_client.V1ObjectMeta(
-            name=name, namespace=namespace, labels=labels or {}
-        ),
-        string_data=data,
-    )
+    manifest = {
+        "apiVersion": "v1",
+        "kind": "Secret",
+        "metadata": {"name": name, "namespace": namespace, "labels": labels or {}},
+        "stringData": data,
+    }
 
     try:
-        try:
-            v1.read_namespaced_secret(name=name, namespace=namespace)
-            # Secret exists, patch it
-            v1.patch_namespaced_secret(name=name, namespace=namespace, body=body)
-            logger.info(f"Updated secret {name} in {namespace}")
-        except ApiException as e:
-            if e.status == 404:
-                # Create new secret
-                v1.create_namespaced_secret(namespace=namespace, body=body)
-                logger.info(f"Created secret {name} in {namespace}")
-            else:
-                raise
+        action = applier.apply(applier.resources.get("v1", "Secret"), manifest)
+        logger.info(f"Secret {name} in {namespace}: {action}")
         return True
     except ApiException as e:
         logger.error(f"Failed to create/update secret {name}: {e}")
         return False
 
 
+def create_secrets(applier: ManifestApplier, secrets: dict) -> list:
+    """
+    Create secrets read from Secrets Manager (see get_secrets_from_sm) in the argocd namespace.
+
+    A "_labels" key holding a JSON object is turned into the secret's labels.
+
+    Returns:
+        Result steps for the secrets that were created
+    """
+    steps = []
+    for secret_name, secret_data in secrets.items():
+        # Shared between clusters: never modify the secrets that were read
+        secret_data = dict(secret_data)
+        labels = {}
+        if "_labels" in secret_data:
+            try:
+                labels = json.loads(secret_data.pop("_labels"))
+            except:
+                pass
+
+        logger.info(f"Creating secret: {secret_name}")
+        if create_secret(applier, secret_name, "argocd", secret_data, labels):
+            steps.append({f"secret_{secret_name}": "created"})
+    return steps
+
+
 def create_configmap(
-    api_client: ApiClient, name: str, namespace: str, data: dict
+    applier: ManifestApplier, name: str, namespace: str, data: dict
 ) -> bool:
     """Create or update a ConfigMap."""
-    v1 = k8s_client.CoreV1Api(api_client)
-
     # All values must be strings
     string_data = {k: str(v) for k, v in data.items()}
 
-    body = k8s_client.V1ConfigMap(
-        metadata=k8s_client.V1ObjectMeta(name=name, namespace=namespace),
-        data=string_data,
-    )
+    manifest = {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": name, "namespace": namespace},
+        "data": string_data,
+    }
 
     try:
-        try:
-            v1.read_namespaced_config_map(name=name, namespace=namespace)
-            v1.patch_namespaced_config_map(name=name, namespace=namespace, body=body)
-            logger.info(f"Updated configmap {name} in {namespace}")
-        except ApiException as e:
-            if e.status == 404:
-                v1.create_namespaced_config_map(namespace=namespace, body=body)
-                logger.info(f"Created configmap {name} in {namespace}")
-            else:
-                raise
+        action = applier.apply(applier.resources.get("v1", "ConfigMap"), manifest)
+        logger.info(f"ConfigMap {name} in {namespace}: {action}")
         return True
     except ApiException as e:
         logger.error(f"Failed to create/update configmap {name}: {e}")
         return False
 
 
-def apply_manifest(api_client: ApiClient, manifest: dict) -> bool:
-    """Apply a generic Kubernetes manifest using dynamic client."""
+def apply_manifest(applier: ManifestApplier, manifest: dict) -> Optional[str]:
+    """
+    Apply a generic Kubernetes manifest using dynamic client.
 
-    dyn_client = dynamic.DynamicClient(api_client)
+    Returns:
+        The action taken (see ManifestApplier.apply), or None if it failed
+    """
 
     api_version = manifest.get("apiVersion", "v1")
     kind = manifest.get("kind")
@@ -231,130 +845,719 @@ def apply_manifest(api_client: ApiClient, manifest: dict) -> bool:
     namespace = metadata.get("namespace")
 
     try:
-        # Get the API resource
-        api = None
-        # Retry discovery for CRDs that might have just been applied
-        for i in range(6):
-            try:
-                api = dyn_client.resources.get(api_version=api_version, kind=kind)
-                break
-            except Exception as e:
-                # If resource/kind not found, wait and retry
-                if i == 5:
-                    logger.warning(f"Resource {kind} ({api_version}) not found after retries: {e}")
-                    raise
-                logger.info(f"Waiting for {kind} CRD to be ready... ({i+1}/6)")
-                time.sleep(5)
-                # Re-initialize client to refresh discovery cache
-                dyn_client = dynamic.DynamicClient(api_client)
-
+        # CRDs are Established before their custom resources are applied (see
+        # apply_object), so a kind that cannot be found is an error, not a reason to wait
         try:
-            if namespace:
-                api.get(name=name, namespace=namespace)
-                try:
-                    # Try default patch (Strategic Merge Patch for native resources)
-                    api.patch(body=manifest, name=name, namespace=namespace)
-                except ApiException as e:
-                    if e.status == 415:
-                        # Fallback to Merge Patch for Custom Resources
-                        api.patch(
-                            body=manifest,
-                            name=name,
-                            namespace=namespace,
-                            content_type="application/merge-patch+json",
-                        )
-                    else:
-                        raise
-                logger.info(f"Updated {kind}/{name} in {namespace}")
-            else:
-                api.get(name=name)
-                try:
-                    # Try default patch
-                    api.patch(body=manifest, name=name)
-                except ApiException as e:
-                    if e.status == 415:
-                        # Fallback to Merge Patch
-                        api.patch(
-                            body=manifest,
-                            name=name,
-                            content_type="application/merge-patch+json",
-                        )
-                    else:
-                        raise
-                logger.info(f"Updated {kind}/{name}")
-        except NotFoundError:
-            if namespace:
-                api.create(body=manifest, namespace=namespace)
-                logger.info(f"Created {kind}/{name} in {namespace}")
-            else:
-                api.create(body=manifest)
-                logger.info(f"Created {kind}/{name}")
-        return True
+            api = applier.resources.get(api_version, kind)
+        except ResourceNotFoundError:
+            if not applier.dry_run:
+                raise
+            # Planned CRDs are not created, so their kinds are not served yet
+            applier.record(manifest, "create")
+            logger.info(f"{kind}/{name}: create (kind not served yet)")
+            return "create"
+
+        action = applier.apply(api, manifest)
+        if namespace:
+            logger.info(f"{kind}/{name} in {namespace}: {action}")
+        else:
+            logger.info(f"{kind}/{name}: {action}")
+        return action
     except Exception as e:
         logger.error(f"Failed to apply {kind}/{name}: {e}")
-        return False
+        return None
 
 
-def apply_argocd_manifests(
-    api_client: ApiClient,
-    manifests_p0: list,
-    manifests_p1: list,
-    manifests_p2: list,
-) -> bool:
+@contextlib.contextmanager
+def open_bundle(source: dict) -> Iterator[io.BufferedIOBase]:
+    """
+    Open a manifest bundle reference as a binary stream.
+
+    References (".gz" marks gzipped content for URIs and paths):
+        {"gzip_base64": "<base64 of gzipped YAML>"}
+        {"uri": "s3://bucket/manifests.yaml.gz"}
+        {"uri": "file:///path/manifests.yaml"} or {"path": "/path/manifests.yaml"}
     """
-    Apply pre-rendered ArgoCD manifests in priority order.
+    with contextlib.ExitStack() as stack:
+        if "gzip_base64" in source:
+            compressed = io.BytesIO(base64.b64decode(source["gzip_base64"]))
+            yield stack.enter_context(gzip.GzipFile(fileobj=compressed))
+            return
+
+        uri = source.get("uri") or source.get("path")
+        location = urlparse(uri)
+        if location.scheme == "s3":
+            s3 = aws_client("s3")
+            body = s3.get_object(Bucket=location.netloc, Key=location.path.lstrip("/"))["Body"]
+            stream = stack.enter_context(contextlib.closing(body))
+        elif location.scheme in ("", "file"):
+            stream = stack.enter_context(open(location.path, "rb"))
+        else:
+            raise ValueError(f"Unsupported manifest bundle URI: {uri}")
+
+        if location.path.endswith(".gz"):
+            stream = stack.enter_context(gzip.GzipFile(fileobj=stream))
+        yield stream
+
+
+def load_manifests(source) -> Iterator[dict]:
+    """
+    Yield the documents of a YAML string or bundle reference one at a time.
+
+    Bundles are decompressed and parsed as they are read, so neither the whole
+    bundle nor all of its documents are held in memory at once.
+    """
+    if isinstance(source, str):
+        yield from yaml.load_all(source, Loader=SafeLoader)
+        return
+    with open_bundle(source) as stream:
+        yield from yaml.load_all(io.TextIOWrapper(stream, encoding="utf-8"), Loader=SafeLoader)
+
+
+def is_established(crd: dict) -> bool:
+    """Check whether a CustomResourceDefinition has the Established condition."""
+    conditions = (crd.get("status") or {}).get("conditions") or []
+    return any(c.get("type") == "Established" and c.get("status") == "True" for c in conditions)
+
+
+def wait_for_crds(resources: ResourceCache, names: set, timeout: float) -> dict:
+    """
+    Watch CustomResourceDefinitions until all of them are Established.
+
+    A failed LIST or WATCH counts as not Established yet and is retried until the
+    timeout.
+
+    Args:
+        resources: Resource cache shared across the invocation
+        names: CRD names to wait for
+        timeout: Seconds to wait in total
+
+    Returns:
+        {crd_name: seconds waited}, None for CRDs not Established within the timeout
+    """
+    api = resources.get("apiextensions.k8s.io/v1", "CustomResourceDefinition")
+    started = time.monotonic()
+    waited = dict.fromkeys(names)
+    pending = set(names)
+    # A single CRD is watched by name instead of streaming every CRD in the cluster
+    field_selector = f"metadata.name={next(iter(names))}" if len(names) == 1 else None
+
+    def observe(crd: dict) -> None:
+        name = crd["metadata"]["name"]
+        if name in pending and is_established(crd):
+            pending.discard(name)
+            waited[name] = round(time.monotonic() - started, 3)
+
+    while pending:
+        remaining = timeout - (time.monotonic() - started)
+        if remaining <= 0:
+            break
+        watcher = watch.Watch()
+        try:
+            # List for the current state, then watch from there until all are Established
+            listing = api.get(field_selector=field_selector).to_dict()
+            for crd in listing.get("items", []):
+                observe(crd)
+            if not pending:
+                break
+
+            for event in resources.client.watch(
+                api,
+                field_selector=field_selector,
+                resource_version=listing["metadata"]["resourceVersion"],
+                timeout=max(1, int(remaining)),
+                watcher=watcher,
+            ):
+                if event["type"] in ("ADDED", "MODIFIED"):
+                    observe(event["raw_object"])
+                if not pending:
+                    watcher.stop()
+        except ApiException as e:
+            # Resource version expired: list again right away
+            if e.status == 410:
+                continue
+            # Anything else means not Established yet: retry until the timeout
+            logger.warning(f"Checking CRDs {sorted(pending)} failed, retrying: {e.status} {e.reason}")
+            time.sleep(min(CRD_RETRY_DELAY, max(0, timeout - (time.monotonic() - started))))
+        except (HTTPError, OSError) as e:
+            logger.warning(f"Checking CRDs {sorted(pending)} failed, retrying: {e}")
+            time.sleep(min(CRD_RETRY_DELAY, max(0, timeout - (time.monotonic() - started))))
+
+    return waited
+
+
+def object_id(manifest: dict) -> str:
+    """Kind/namespace/name (Kind/name for cluster-scoped objects), for logs and results."""
+    metadata = manifest.get("metadata", {})
+    namespace = metadata.get("namespace")
+    if namespace:
+        return f"{manifest.get('kind')}/{namespace}/{metadata.get('name')}"
+    return f"{manifest.get('kind')}/{metadata.get('name')}"
+
+
+def pod_spec(manifest: dict) -> dict:
+    """Return the pod spec of a workload manifest (empty for other kinds)."""
+    kind = manifest.get("kind")
+    spec = manifest.get("spec") or {}
+    if kind == "Pod":
+        return spec
+    if kind == "CronJob":
+        spec = (spec.get("jobTemplate") or {}).get("spec") or {}
+    elif kind not in ("Deployment", "StatefulSet", "DaemonSet", "ReplicaSet", "Job"):
+        return {}
+    return (spec.get("template") or {}).get("spec") or {}
+
+
+def pod_references(spec: dict) -> set:
+    """Return the (kind, name) of ServiceAccounts, ConfigMaps and Secrets a pod spec uses."""
+    refs = set()
+    if spec.get("serviceAccountName"):
+        refs.add(("ServiceAccount", spec["serviceAccountName"]))
+    for secret in spec.get("imagePullSecrets") or []:
+        refs.add(("Secret", secret.get("name")))
+
+    for volume in spec.get("volumes") or []:
+        if "configMap" in volume:
+            refs.add(("ConfigMap", volume["configMap"].get("name")))
+        if "secret" in volume:
+            refs.add(("Secret", volume["secret"].get("secretName")))
+        for source in (volume.get("projected") or {}).get("sources") or []:
+            if "configMap" in source:
+                refs.add(("ConfigMap", source["configMap"].get("name")))
+            if "secret" in source:
+                refs.add(("Secret", source["secret"].get("name")))
+
+    for container in (spec.get("initContainers") or []) + (spec.get("containers") or []):
+        for env_from in container.get("envFrom") or []:
+            if "configMapRef" in env_from:
+                refs.add(("ConfigMap", env_from["configMapRef"].get("name")))
+            if "secretRef" in env_from:
+                refs.add(("Secret", env_from["secretRef"].get("name")))
+        for env in container.get("env") or []:
+            value_from = env.get("valueFrom") or {}
+            if "configMapKeyRef" in value_from:
+                refs.add(("ConfigMap", value_from["configMapKeyRef"].get("name")))
+            if "secretKeyRef" in value_from:
+                refs.add(("Secret", value_from["secretKeyRef"].get("name")))
+    return refs
+
+
+def manifest_problem(manifest: Any) -> Optional[str]:
+    """Why a parsed document cannot be applied as a manifest, or None if it can."""
+    if not isinstance(manifest, dict):
+        return f"document is a {type(manifest).__name__}, not a mapping"
+    if not isinstance(manifest.get("kind"), str):
+        return "kind is missing or not a string"
+    if not isinstance(manifest.get("apiVersion", "v1"), str):
+        return "apiVersion is not a string"
+    metadata = manifest.get("metadata")
+    if not isinstance(metadata, dict):
+        return f"{manifest['kind']} metadata is missing or not a mapping"
+    for field in ("name", "namespace"):
+        if not isinstance(metadata.get(field, ""), str):
+            return f"{manifest['kind']} metadata.{field} is not a string"
+    return None
+
+
+def manifest_summary(manifest: dict) -> dict:
+    """Keep only what manifest_dependencies and object_id need from a manifest."""
+    metadata = manifest.get("metadata") or {}
+    summary = {
+        "apiVersion": manifest.get("apiVersion", "v1"),
+        "kind": manifest.get("kind"),
+        "metadata": {"name": metadata.get("name"), "namespace": metadata.get("namespace")},
+        "references": pod_references(pod_spec(manifest)),
+    }
+    if manifest.get("kind") == "CustomResourceDefinition":
+        spec = manifest.get("spec") or {}
+        summary["spec"] = {"group": spec.get("group"), "names": {"kind": (spec.get("names") or {}).get("kind")}}
+    return summary
+
+
+def manifest_dependencies(manifests: list) -> list:
+    """
+    Infer which manifests must be applied before each manifest.
+
+    Edges are only added between manifests in the list: a Namespace before the
+    objects in it, a CRD before its custom resources, and ServiceAccounts,
+    ConfigMaps and Secrets before the workloads that reference them.
 
     Args:
-        api_client: Configured Kubernetes API client
-        manifests_p0: Priority 0 manifests (CRDs, Namespaces) - must be applied first
+        manifests: Manifest summaries (see manifest_summary)
+
+    Returns:
+        For each manifest, the set of indexes of the manifests it depends on
+    """
+    objects = {}
+    crds = {}
+    for i, manifest in enumerate(manifests):
+        metadata = manifest.get("metadata", {})
+        objects[(manifest.get("kind"), metadata.get("namespace"), metadata.get("name"))] = i
+        if manifest.get("kind") == "CustomResourceDefinition":
+            spec = manifest.get("spec", {})
+            crds[(spec.get("group"), spec.get("names", {}).get("kind"))] = i
+
+    dependencies = []
+    for i, manifest in enumerate(manifests):
+        namespace = manifest.get("metadata", {}).get("namespace")
+        group = manifest.get("apiVersion", "v1").rpartition("/")[0]
+        edges = {
+            objects.get(("Namespace", None, namespace)),
+            crds.get((group, manifest.get("kind"))),
+        }
+        for kind, name in manifest["references"]:
+            edges.add(objects.get((kind, namespace, name)))
+        edges.discard(None)
+        edges.discard(i)
+        dependencies.append(edges)
+    return dependencies
+
+
+def plan_waves(dependencies: list) -> list:
+    """Group manifest indexes into waves that only depend on earlier waves."""
+    remaining = dict(enumerate(dependencies))
+    done = set()
+    waves = []
+    while remaining:
+        wave = [i for i, edges in remaining.items() if edges <= done]
+        if not wave:
+            # Dependency cycle: apply whatever is left together
+            logger.warning(f"Dependency cycle between {len(remaining)} manifests")
+            wave = list(remaining)
+        waves.append(wave)
+        done.update(wave)
+        for i in wave:
+            del remaining[i]
+    return waves
+
+
+def apply_object(
+    applier: ManifestApplier, manifest: dict, crd_timeout: float, crd_wait: dict
+) -> Optional[str]:
+    """
+    Apply a manifest; a CRD only counts as applied once it is Established.
+
+    Returns:
+        The action taken (see ManifestApplier.apply), or None if it failed
+    """
+    action = apply_manifest(applier, manifest)
+    if action is None:
+        return None
+    # Nothing is created in a dry run, so there is nothing to wait for
+    if manifest.get("kind") != "CustomResourceDefinition" or applier.dry_run:
+        return action
+
+    name = manifest["metadata"]["name"]
+    seconds = wait_for_crds(applier.resources, {name}, crd_timeout)[name]
+    crd_wait[name] = seconds
+    if seconds is None:
+        logger.warning(f"CRD {name} not Established after {crd_timeout}s")
+        return None
+    logger.info(f"CRD {name} Established after {seconds}s")
+    return action
+
+
+def parse_manifests(manifests_p0: list, manifests_p1: list, manifests_p2: list) -> dict:
+    """
+    Parse pre-rendered ArgoCD manifests and plan their dependency waves, once for
+    every cluster they are applied to.
+
+    Args:
+        manifests_p0: Priority 0 manifests (CRDs, Namespaces)
         manifests_p1: Priority 1 manifests (Core resources)
-        manifests_p2: Priority 2 manifests (Custom Resources) - applied last
+        manifests_p2: Priority 2 manifests (Custom Resources)
+            Each is a list of YAML strings or bundle references (see open_bundle)
 
     Returns:
-        True if all manifests were applied successfully
+        {"summaries": [...], "documents": [...], "dependencies": [...], "waves": [...],
+         "failed": sources that could not be parsed and invalid documents,
+         "digest": sha256 of the documents}
     """
-    all_manifests = [
-        ("p0 (CRDs/Namespaces)", manifests_p0),
-        ("p1 (Core resources)", manifests_p1),
-        ("p2 (Custom Resources)", manifests_p2),
-    ]
+    summaries = []
+    documents = []
+    failed = 0
+    digest = hashlib.sha256()
+    for source in manifests_p0 + manifests_p1 + manifests_p2:
+        try:
+            for manifest in load_manifests(source):
+                # Skip empty documents
+                if not manifest:
+                    continue
+                # A malformed document counts as one failure instead of failing the bundle
+                problem = manifest_problem(manifest)
+                if problem is None:
+                    try:
+                        summary = manifest_summary(manifest)
+                    except (AttributeError, TypeError) as e:
+                        problem = str(e)
+                if problem is not None:
+                    logger.error(f"Invalid manifest: {problem}")
+                    failed += 1
+                    continue
+                summaries.append(summary)
+                document = json.dumps(manifest, default=str).encode()
+                digest.update(hashlib.sha256(document).digest())
+                # Hold documents compressed until they are applied, so memory tracks
+                # the bundle size rather than every parsed document
+                documents.append(zlib.compress(document, 1))
+        except (yaml.YAMLError, OSError, ValueError, ClientError) as e:
+            logger.error(f"Failed to parse manifest: {e}")
+            failed += 1
+
+    dependencies = manifest_dependencies(summaries)
+    return {
+        "summaries": summaries,
+        "documents": documents,
+        "dependencies": dependencies,
+        "waves": plan_waves(dependencies),
+        "failed": failed,
+        "digest": digest.hexdigest(),
+    }
 
-    total_success = 0
-    total_fail = 0
 
-    for priority_name, manifests in all_manifests:
-        if not manifests:
-            logger.info(f"No {priority_name} manifests to apply")
-            continue
+def apply_argocd_manifests(
+    applier: ManifestApplier,
+    bundle: dict,
+    crd_timeout: float = 120,
+    workers: int = APPLY_WORKERS,
+    deadline: Optional[float] = None,
+    checkpoint: Optional[Checkpoint] = None,
+) -> dict:
+    """
+    Apply parsed ArgoCD manifests (see parse_manifests) in dependency order.
 
-        logger.info(f"Applying {len(manifests)} {priority_name} manifests")
-        success_count = 0
-        fail_count = 0
+    Objects are applied in waves (see manifest_dependencies), each wave concurrently
+    on a bounded worker pool. A CRD completes once it is Established. When an object
+    fails, everything depending on it is skipped and reported while unrelated objects
+    are still applied. Past the deadline no new object is started.
 
-        for yaml_content in manifests:
-            try:
-                # Parse YAML (could be multi-document)
-                for manifest in yaml.safe_load_all(yaml_content):
-                    if manifest:  # Skip empty documents
-                        if apply_manifest(api_client, manifest):
-                            success_count += 1
-                        else:
-                            fail_count += 1
-            except Exception as e:
-                logger.error(f"Failed to parse/apply manifest: {e}")
-                fail_count += 1
+    With a checkpoint, objects applied by an earlier invocation of the same bundle are
+    not applied again, and progress is saved after every wave that changed objects.
+    It is cleared once every object has been applied, if it was ever saved.
 
-        logger.info(f"{priority_name}: Applied {success_count}, failed {fail_count}")
-        total_success += success_count
-        total_fail += fail_count
+    Args:
+        applier: Manifest applier shared across the cluster's bootstrap
+        bundle: Parsed manifests; read only, so it can be shared between clusters
+        crd_timeout: Seconds to wait for each CRD to become Established
+        workers: Maximum concurrent applies
+        deadline: time.monotonic() after which the remaining objects are left pending
+        checkpoint: Progress of earlier invocations, updated as objects are applied
 
+    Returns:
+        {"applied": n, "failed": n, "skipped": [{"object", "blocked_by"}, ...],
+         "pending": n, "resumed": n, "waves": n, "crd_wait": {crd_name: seconds or None}}
+    """
+    manifests = bundle["summaries"]
+    documents = bundle["documents"]
+    dependencies = bundle["dependencies"]
+    waves = bundle["waves"]
+    metrics = applier.metrics
+
+    def apply_document(i: int) -> Optional[str]:
+        """The object's action, "failed", or None if the deadline passed first."""
+        timeout = crd_timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                return None
+        started = time.perf_counter()
+        manifest = json.loads(zlib.decompress(documents[i]))
+        try:
+            action = apply_object(applier, manifest, timeout, crd_wait) or "failed"
+        except Exception as e:
+            # Fails this object and its dependents only, not the wave or the bootstrap
+            logger.error(f"Failed to apply {object_id(manifests[i])}: {e}")
+            action = "failed"
+        if metrics:
+            outcome = "failed" if action == "failed" else "applied"
+            metrics.observe(object_id(manifests[i]), time.perf_counter() - started, outcome)
+        return action
+
+    # Indices of the objects applied, now or by earlier invocations
+    done = checkpoint.load() if checkpoint else set()
+    resumed = len(done)
+    checkpointed = len(done)
     logger.info(
-        f"Total ArgoCD manifests: {total_success} applied, {total_fail} failures"
+        f"Applying {len(manifests) - resumed} manifests in {len(waves)} waves ({workers} workers)"
     )
-    return total_fail == 0
 
+    total_success = 0
+    total_fail = bundle["failed"]
+    pending = 0
+    failed = set()
+    skipped = []
+    crd_wait = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for number, wave in enumerate(waves):
+            if deadline is not None and time.monotonic() >= deadline:
+                pending += sum(i not in done for rest in waves[number:] for i in rest)
+                logger.warning(f"Deadline reached before wave {number}, {pending} objects pending")
+                break
+
+            runnable = []
+            blocked_count = 0
+            for i in wave:
+                blocked = dependencies[i] & failed
+                if blocked:
+                    blocked_count += 1
+                    failed.add(i)
+                    skipped.append({
+                        "object": object_id(manifests[i]),
+                        "blocked_by": object_id(manifests[min(blocked)]),
+                    })
+                elif i not in done:
+                    runnable.append(i)
+
+            outcomes = pool.map(apply_document, runnable)
+            success_count = 0
+            fail_count = 0
+            changed = False
+            for i, action in zip(runnable, outcomes):
+                if action is None:
+                    pending += 1
+                elif action == "failed":
+                    fail_count += 1
+                    failed.add(i)
+                else:
+                    success_count += 1
+                    done.add(i)
+                    changed = changed or action != "unchanged"
+            logger.info(
+                f"Wave {number}: Applied {success_count}, failed {fail_count}, "
+                f"skipped {blocked_count}"
+            )
+            total_success += success_count
+            total_fail += fail_count
+            # Only this wave's outcomes count: the applier's stats also include secrets
+            # created in the background. A wave of unchanged objects is not worth a write;
+            # its objects are saved with the next wave that changes something.
+            if checkpoint and changed and len(done) != checkpointed:
+                checkpoint.save(done)
+                checkpointed = len(done)
+
+    if checkpoint and len(done) == len(manifests):
+        checkpoint.clear()
+
+    for entry in skipped:
+        logger.warning(f"Skipped {entry['object']}: {entry['blocked_by']} failed")
+    logger.info(
+        f"Total ArgoCD manifests: {total_success} applied, {total_fail} failures, "
+        f"{len(skipped)} skipped, {pending} pending, {resumed} done earlier"
+    )
+    return {
+        "applied": total_success,
+        "failed": total_fail,
+        "skipped": skipped,
+        "pending": pending,
+        "resumed": resumed,
+        "waves": len(waves),
+        "crd_wait": crd_wait,
+    }
 
 
+def read_shared_secrets(secret_arns: list, region: str) -> tuple:
+    """
+    Read the secrets every cluster of the invocation gets.
+
+    Returns:
+        (secrets as returned by get_secrets_from_sm, {retry reason: count})
+    """
+    tally = BootstrapMetrics("shared")
+    return get_secrets_from_sm(secret_arns, region, tally), dict(tally.retries)
+
+
+def bootstrap_cluster(
+    cluster_name: str,
+    region: str,
+    cluster_config: dict,
+    options: dict,
+    shared: dict,
+    deadline: Optional[float] = None,
+    cold_start: bool = False,
+    timeout: Optional[float] = None,
+) -> dict:
+    """
+    Bootstrap one cluster: namespace, ArgoCD manifests, secrets and cluster-config.
+
+    Every cluster has its own client, discovery cache, applier and metrics, and any
+    error is caught and reported in its results, so clusters bootstrapped together
+    cannot affect each other.
+
+    Args:
+        cluster_name: EKS cluster name
+        region: AWS region of the cluster
+        cluster_config: Data of the cluster-config ConfigMap
+        options: apply_mode, plan, reapply and crd_timeout from the event
+        shared: Futures of the inputs read once per invocation:
+            "secrets" (read_shared_secrets) and "bundle" (parse_manifests), or None
+        deadline: time.monotonic() after which no new step or object is started; the
+            cluster's results are then marked resumable
+        cold_start: Whether this is the first invocation of the execution environment
+        timeout: Seconds this cluster may take, counted from when it starts rather than
+            from the invocation, so clusters queued behind others get the full time
+
+    Returns:
+        The cluster's results
+    """
+    started = time.perf_counter()
+    logger.info(f"Bootstrap started for cluster: {cluster_name}")
+    if timeout:
+        cluster_deadline = time.monotonic() + timeout
+        deadline = cluster_deadline if deadline is None else min(deadline, cluster_deadline)
+    plan = options["plan"]
+    metrics = BootstrapMetrics(cluster_name)
+    results = {"success": True, "steps": []}
+    api_client = None
+    resources = None
+    applier = None
+
+    def read_secrets() -> list:
+        with metrics.step("secrets"):
+            secrets, retries = shared["secrets"].result()
+            for reason, count in retries.items():
+                metrics.retry(reason, count)
+            return create_secrets(applier, secrets)
+
+    def expired() -> bool:
+        return deadline is not None and time.monotonic() >= deadline
+
+    try:
+        # Get cluster info and authenticate
+        logger.info(f"Getting cluster info for {cluster_name}")
+        with metrics.step("cluster_info"):
+            cluster_info = get_cluster_info(cluster_name, region)
+
+        logger.info("Generating EKS token")
+        with metrics.step("authenticate"):
+            auth = get_eks_auth(cluster_name, region)
+
+        # Create K8s client
+        api_client = create_k8s_client(
+            cluster_info["endpoint"], cluster_info["ca_data"], auth
+        )
+        metrics.instrument(api_client)
+
+        resources = ResourceCache(api_client)
+        applier = ManifestApplier(
+            resources,
+            server_side=options["apply_mode"] == "server-side",
+            dry_run=plan,
+            skip_unchanged=not options["reapply"],
+            metrics=metrics,
+        )
+        if plan:
+            logger.info("Plan mode: changes are dry-run only")
+
+        # Step 1: Create argocd namespace
+        logger.info("Creating argocd namespace")
+        with metrics.step("namespace"):
+            created = create_namespace(applier, "argocd")
+        if created:
+            results["steps"].append({"namespace": "created"})
+
+        # Steps 2 and 3 overlap: secrets are created in the background while the
+        # ArgoCD manifests are applied
+        with ThreadPoolExecutor(max_workers=1) as background:
+            secret_steps = None
+            if shared["secrets"] is not None:
+                secret_steps = background.submit(read_secrets)
+
+            # Step 2: Install ArgoCD (from pre-rendered manifests in dependency order)
+            if shared["bundle"] is not None:
+                logger.info(
+                    "Installing ArgoCD from pre-rendered manifests (dependency order)"
+                )
+                bundle = shared["bundle"].result()
+                # Nothing is persisted in a dry run, so there is no progress to keep
+                checkpoint = None if plan else Checkpoint(applier, bundle["digest"])
+                with metrics.step("argocd_manifests"):
+                    summary = apply_argocd_manifests(
+                        applier,
+                        bundle,
+                        options["crd_timeout"],
+                        deadline=deadline,
+                        checkpoint=checkpoint,
+                    )
+                results["crd_wait"] = summary["crd_wait"]
+                if summary["skipped"]:
+                    results["skipped"] = summary["skipped"]
+                if summary["pending"]:
+                    results["pending"] = summary["pending"]
+                if summary["resumed"]:
+                    results["resumed"] = summary["resumed"]
+                if summary["failed"] == 0 and not summary["skipped"] and not summary["pending"]:
+                    results["steps"].append({"argocd": "installed"})
+                else:
+                    logger.warning("ArgoCD installation had issues, continuing...")
+
+            # Step 3: Create secrets from Secrets Manager
+            if secret_steps is not None:
+                results["steps"].extend(secret_steps.result())
+
+        # Step 4: Create cluster-config ConfigMap
+        if cluster_config and not expired():
+            logger.info("Creating cluster-config ConfigMap")
+            with metrics.step("cluster_config"):
+                created = create_configmap(applier, "cluster-config", "argocd", cluster_config)
+            if created:
+                results["steps"].append({"configmap_cluster_config": "created"})
+
+        if expired():
+            # Progress is checkpointed: invoking again with the same event resumes
+            results["resumable"] = True
+            raise TimeoutError(f"Timed out after {time.perf_counter() - started:.1f}s")
+
+        logger.info(f"Bootstrap completed for {cluster_name}: {results}")
+        return results
+
+    except Exception as e:
+        logger.error(f"Bootstrap failed for {cluster_name}: {e}")
+        # The cluster may have been replaced; describe it again next time
+        if not isinstance(e, TimeoutError):
+            forget_cluster(cluster_name, region)
+        results["success"] = False
+        results["error"] = str(e)
+        return results
+
+    finally:
+        if api_client is not None:
+            api_client.close()
+        if resources is not None:
+            results["discovery"] = resources.stats
+            logger.info(f"Discovery cache: {resources.stats}")
+        if applier is not None:
+            results["objects"] = applier.stats
+            logger.info(f"Objects: {applier.stats}")
+            results["apply_mode"] = "server-side" if applier.server_side else "client-side"
+            if plan:
+                results["plan"] = applier.plan
+        results["timing"] = {
+            "cold_start": cold_start,
+            "duration_seconds": round(time.perf_counter() - started, 3),
+        }
+        if metrics.enabled:
+            results["metrics"] = metrics.summary()
+            objects = applier.stats if applier else {"applied": 0, "skipped": 0}
+            discovery = resources.stats if resources else {"hits": 0, "misses": 0}
+            crd_wait = [seconds for seconds in results.get("crd_wait", {}).values() if seconds]
+            metrics.emit({
+                "DurationSeconds": (results["timing"]["duration_seconds"], "Seconds"),
+                "ColdStart": (int(cold_start), "Count"),
+                "Success": (int(results["success"]), "Count"),
+                "ObjectsApplied": (objects["applied"], "Count"),
+                "ObjectsSkipped": (objects["skipped"], "Count"),
+                "ObjectsBlocked": (len(results.get("skipped", [])), "Count"),
+                "ObjectsPending": (results.get("pending", 0), "Count"),
+                "DiscoveryHits": (discovery["hits"], "Count"),
+                "DiscoveryMisses": (discovery["misses"], "Count"),
+                "CrdWaitSeconds": (round(sum(crd_wait), 3), "Seconds"),
+            })
+
+
+def event_flag(value: Any) -> bool:
+    """Read a boolean event key; payloads from CLIs and Step Functions often send strings."""
+    return str(value).strip().lower() in ("1", "true", "yes")
+
 
 def handler(event: dict, context: Any) -> dict:
     """
@@ -370,87 +1573,107 @@ def handler(event: dict, context: Any) -> dict:
         "argocd_manifests_p0": [...],  # Priority 0: CRDs, Namespaces
         "argocd_manifests_p1": [...],  # Priority 1: Core resources
         "argocd_manifests_p2": [...],  # Priority 2: Custom Resources
-        "cluster_config": { ... }
+                                       # (applied in inferred dependency order)
+        # Each tier is a list of YAML strings or bundle references:
+        # {"gzip_base64": ...}, {"uri": "s3://bucket/key.yaml.gz"}, {"path": ...}
+        "cluster_config": { ... },
+        "apply_mode": "server-side",  # Optional: or "client-side" (get/patch/create)
+        "plan": false,  # Optional: dry-run, report what would change in "plan"
+        "crd_timeout": 120,  # Optional: seconds to wait for applied CRDs to be Established
+        "reapply": false  # Optional: apply objects even if their desired-state hash is unchanged
+    }
+
+    To bootstrap several clusters with the same secrets and manifests, replace
+    cluster_name with a list of clusters. Each cluster's cluster_config is merged over
+    the shared one, and results are reported per cluster:
+    {
+        "clusters": [
+            {"cluster_name": "platform-09-main-01", "cluster_config": { ... }},
+            {"cluster_name": "platform-09-main-02", "region": "eu-west-1"}
+        ],
+        "cluster_timeout": 300,  # Optional: seconds before a cluster's bootstrap stops
+        ...
     }
     """
-    logger.info(f"Bootstrap started for cluster: {event.get('cluster_name')}")
+    global _cold_start
+    invocation_started = time.perf_counter()
+    cold_start, _cold_start = _cold_start, False
 
-    cluster_name = event["cluster_name"]
     region = event.get("region", os.environ.get("AWS_REGION", "eu-central-1"))
     explicit_secrets = event.get("secrets", [])
     argocd_manifests_p0 = event.get("argocd_manifests_p0", [])
     argocd_manifests_p1 = event.get("argocd_manifests_p1", [])
     argocd_manifests_p2 = event.get("argocd_manifests_p2", [])
     cluster_config = event.get("cluster_config", {})
-
-    # Get cluster info and authenticate
-    logger.info(f"Getting cluster info for {cluster_name}")
-    cluster_info = get_cluster_info(cluster_name, region)
-
-    logger.info("Generating EKS token")
-    auth = EKSAuth(cluster_name, region)
-    token = auth.get_token()
-
-    # Create K8s client
-    api_client = create_k8s_client(
-        cluster_info["endpoint"], cluster_info["ca_data"], token
+    options = {
+        "apply_mode": event.get("apply_mode", os.environ.get("APPLY_MODE", "server-side")),
+        "plan": event_flag(event.get("plan", False)),
+        "reapply": event_flag(event.get("reapply", False)),
+        "crd_timeout": float(event.get("crd_timeout", os.environ.get("CRD_READY_TIMEOUT", 120))),
+    }
+    fan_out = "clusters" in event
+    clusters = event["clusters"] if fan_out else [{"cluster_name": event["cluster_name"]}]
+    names = [cluster["cluster_name"] for cluster in clusters]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate cluster_name in clusters: {', '.join(duplicates)}")
+    # Per cluster, started when the cluster's bootstrap starts
+    cluster_timeout = event.get("cluster_timeout", os.environ.get("CLUSTER_TIMEOUT"))
+    cluster_timeout = float(cluster_timeout) if cluster_timeout else None
+    deadline = None
+    # Stop while there is still time to checkpoint and return, rather than be killed
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - TIMEOUT_MARGIN
+    logger.info(
+        f"Bootstrap started for cluster(s): {', '.join(c['cluster_name'] for c in clusters)}"
     )
 
-    results = {"success": True, "steps": []}
-
-    try:
-        # Step 1: Create argocd namespace
-        logger.info("Creating argocd namespace")
-        if create_namespace(api_client, "argocd"):
-            results["steps"].append({"namespace": "created"})
-
-        # Step 2: Install ArgoCD (from pre-rendered manifests in priority order)
-        has_manifests = (
-            argocd_manifests_p0 or argocd_manifests_p1 or argocd_manifests_p2
-        )
-        if has_manifests:
-            logger.info(
-                "Installing ArgoCD from pre-rendered manifests (priority order)"
+    # Secrets and manifests are read once, while the clusters are being connected to
+    with ThreadPoolExecutor(max_workers=2) as background:
+        shared = {"secrets": None, "bundle": None}
+        if explicit_secrets:
+            shared["secrets"] = background.submit(read_shared_secrets, explicit_secrets, region)
+        if argocd_manifests_p0 or argocd_manifests_p1 or argocd_manifests_p2:
+            shared["bundle"] = background.submit(
+                parse_manifests, argocd_manifests_p0, argocd_manifests_p1, argocd_manifests_p2
             )
-            if apply_argocd_manifests(
-                api_client,
-                argocd_manifests_p0,
-                argocd_manifests_p1,
-                argocd_manifests_p2,
-            ):
-                results["steps"].append({"argocd": "installed"})
-            else:
-                logger.warning("ArgoCD installation had issues, continuing...")
-
-        # Step 3: Read and create secrets from Secrets Manager
-        secrets = get_secrets_from_sm(explicit_secrets, region)
-        for secret_name, secret_data in secrets.items():
-            labels = {}
-            if "_labels" in secret_data:
-                try:
-                    labels = json.loads(secret_data.pop("_labels"))
-                except:
-                    pass
-
-            logger.info(f"Creating secret: {secret_name}")
-            if create_secret(api_client, secret_name, "argocd", secret_data, labels):
-                results["steps"].append({f"secret_{secret_name}": "created"})
-
-        # Step 4: Create cluster-config ConfigMap
-        if cluster_config:
-            logger.info("Creating cluster-config ConfigMap")
-            if create_configmap(api_client, "cluster-config", "argocd", cluster_config):
-                results["steps"].append({"configmap_cluster_config": "created"})
 
+        with ThreadPoolExecutor(max_workers=max(1, min(CLUSTER_WORKERS, len(clusters)))) as pool:
+            futures = {
+                cluster["cluster_name"]: pool.submit(
+                    bootstrap_cluster,
+                    cluster["cluster_name"],
+                    cluster.get("region", region),
+                    {**cluster_config, **cluster.get("cluster_config", {})},
+                    options,
+                    shared,
+                    deadline,
+                    cold_start,
+                    cluster_timeout,
+                )
+                for cluster in clusters
+            }
+            cluster_results = {name: future.result() for name, future in futures.items()}
+
+    if fan_out:
+        results = {
+            "success": all(result["success"] for result in cluster_results.values()),
+            "clusters": cluster_results,
+        }
+        if any(result.get("resumable") for result in cluster_results.values()):
+            results["resumable"] = True
+    else:
+        results = cluster_results[event["cluster_name"]]
+
+    results["timing"] = {
+        "cold_start": cold_start,
+        "duration_seconds": round(time.perf_counter() - invocation_started, 3),
+    }
+    if cold_start:
+        results["timing"]["import_seconds"] = IMPORT_SECONDS
+    logger.info(f"Invocation timing: {results['timing']}")
+    return results
 
-        logger.info(f"Bootstrap completed: {results}")
-        return results
-
-    except Exception as e:
-        logger.error(f"Bootstrap failed: {e}")
-        results["success"] = False
-        results["error"] = str(e)
-        return results
 
-    finally:
-        api_client.close()
+# Last statement of the module, so it covers every import and definition above
+IMPORT_SECONDS = round(time.perf_counter() - _IMPORT_STARTED, 3)
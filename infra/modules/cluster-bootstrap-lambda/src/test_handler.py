@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Tests for handler.py, run end to end against the fake API server in fake_kube.py with
+the stubbed AWS clients of benchmark.py. Not part of the Lambda package.
+
+    python3 -m unittest test_handler     (or pytest, from this directory)
+"""
+
+import contextlib
+import io
+import json
+import logging
+import unittest
+from unittest import mock
+
+import yaml
+
+import benchmark
+import handler
+from fake_kube import FakeKubeServer
+from kubernetes.client.rest import ApiException
+
+
+class ApplyTest(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger().setLevel(logging.CRITICAL)
+        self.addCleanup(logging.getLogger().setLevel, logging.INFO)
+
+    def bootstrap(self, event: dict, **server_options) -> tuple:
+        """Run handler() on the event against a fresh server; returns (results, server)."""
+        secrets = {entry["arn"]: json.dumps({"token": entry["arn"]}) for entry in event["secrets"]}
+        with FakeKubeServer(**server_options) as server:
+            benchmark.reset_handler(server.url, secrets)
+            # EMF records go to stdout
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = handler.handler(event, None)
+        return results, server
+
+    def test_failed_crd_check_only_skips_its_dependents(self):
+        event = benchmark.generate_event(100)
+        applicationset = {
+            "apiVersion": "argoproj.io/v1alpha1",
+            "kind": "ApplicationSet",
+            "metadata": {"name": "apps", "namespace": "argocd"},
+            "spec": {},
+        }
+        event["argocd_manifests_p2"].append(yaml.safe_dump(applicationset))
+        event["crd_timeout"] = 1
+
+        results, server = self.bootstrap(event, fail_lists=("applicationsets.argoproj.io",))
+
+        self.assertEqual(results["crd_wait"]["applicationsets.argoproj.io"], None)
+        self.assertIsNotNone(results["crd_wait"]["applications.argoproj.io"])
+        self.assertEqual(results["skipped"], [{
+            "object": "ApplicationSet/argocd/apps",
+            "blocked_by": "CustomResourceDefinition/applicationsets.argoproj.io",
+        }])
+        # Everything but the ApplicationSet is in the cluster, the CRD itself included
+        kinds = {key[2] for key in server.state.objects}
+        self.assertIn("applications", kinds)
+        self.assertNotIn("applicationsets", kinds)
+        applications = [key for key in server.state.objects if key[2] == "applications"]
+        self.assertEqual(len(applications), sum(
+            document["kind"] == "Application"
+            for text in event["argocd_manifests_p2"] for document in yaml.safe_load_all(text)
+        ))
+        self.assertIn(("", "v1", "configmaps", "argocd", "cluster-config"), server.state.objects)
+
+    def test_unexpected_crd_error_only_skips_its_dependents(self):
+        event = benchmark.generate_event(100)
+        wait_for_crds = handler.wait_for_crds
+
+        def failing(resources, names, timeout):
+            if "appprojects.argoproj.io" in names:
+                raise ApiException(status=403, reason="Forbidden")
+            return wait_for_crds(resources, names, timeout)
+
+        with mock.patch.object(handler, "wait_for_crds", failing):
+            results, server = self.bootstrap(event)
+
+        self.assertNotIn("error", results)
+        self.assertEqual(results["skipped"], [{
+            "object": "AppProject/argocd/default",
+            "blocked_by": "CustomResourceDefinition/appprojects.argoproj.io",
+        }])
+        applications = [key for key in server.state.objects if key[2] == "applications"]
+        self.assertEqual(len(applications), len(list(yaml.safe_load_all(event["argocd_manifests_p2"][0]))) - 1)
+        self.assertIn(("", "v1", "configmaps", "argocd", "cluster-config"), server.state.objects)
+
+    def test_unchanged_rerun_does_not_write(self):
+        event = benchmark.generate_event(100)
+        secrets = {entry["arn"]: json.dumps({"token": entry["arn"]}) for entry in event["secrets"]}
+        with FakeKubeServer() as server:
+            benchmark.reset_handler(server.url, secrets)
+            with contextlib.redirect_stdout(io.StringIO()):
+                handler.handler(event, None)
+                before = dict(server.state.requests)
+                results = handler.handler(event, None)
+        self.assertTrue(results["success"])
+        # Neither the objects nor the checkpoint ConfigMap
+        self.assertEqual(
+            {verb for verb, count in server.state.requests.items() if count != before.get(verb, 0)},
+            {"get"},
+        )
+
+    def test_server_errors_do_not_abort_the_bootstrap(self):
+        event = benchmark.generate_event(100)
+        results, server = self.bootstrap(event, error_rate=0.05, seed=0)
+        self.assertNotIn("error", results)
+        self.assertEqual(set(results["crd_wait"]), {
+            "applications.argoproj.io", "appprojects.argoproj.io", "applicationsets.argoproj.io",
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,7 +13,11 @@ variable "subnet_ids" {
   type        = list(string)
 }
 
-
+variable "manifest_bucket_arns" {
+  description = "S3 bucket ARNs the Lambda may read manifest bundles from (s3:// references in the event)"
+  type        = list(string)
+  default     = []
+}
 
 variable "tags" {
   description = "Tags to apply to resources"